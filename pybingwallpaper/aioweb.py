@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+asyncio based http engine built on stdlib only: asyncio streams carry the
+bytes and http.client parses the headers.
+
+All requests share one event loop running in a background thread, so any
+number of them may be in flight at the same time no matter how many
+threads wait for them. Coroutines can use AsyncEngine.request directly,
+synchronous code uses AsyncEngine.urlopen which mimics urllib's urlopen
+and is plugged into webutil by webutil.set_engine('asyncio').
+"""
+import asyncio
+import http.client
+import io
+import socket
+import ssl
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
+
+from . import log
+
+_logger = log.getChild('aioweb')
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# a whole body is read in pieces of this size, each under its own timeout
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncResponse:
+    """
+    Response whose body is read from the stream on demand. The connection
+    goes back to the engine once the body is completely read.
+    """
+
+    def __init__(self, engine, key, reader, writer, method, status, reason, headers):
+        self.engine = engine
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+        length = headers.get('Content-Length', None)
+        self.length = int(length) if length is not None and not self.chunked else None
+        self.will_close = headers.get('Connection', '').lower() == 'close'
+        self._chunk_left = 0
+        self._done = False
+        if method == 'HEAD' or status in (204, 304) or self.length == 0:
+            self._finish()
+
+    def _finish(self):
+        if self._done:
+            return
+        self._done = True
+        if self.will_close:
+            self.writer.close()
+        else:
+            self.engine._release(self.key, self.reader, self.writer)
+
+    def abort(self):
+        if not self._done:
+            self._done = True
+            self.writer.close()
+
+    async def _read_chunked(self, amt):
+        if not self._chunk_left:
+            line = await self.reader.readline()
+            size = int(line.split(b';', 1)[0].strip() or b'0', 16)
+            if not size:
+                # skip trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                self._finish()
+                return b''
+            self._chunk_left = size
+        data = await self.reader.read(self._chunk_left if amt < 0 else min(amt, self._chunk_left))
+        if not data:
+            raise http.client.IncompleteRead(data)
+        self._chunk_left -= len(data)
+        if not self._chunk_left:
+            await self.reader.readexactly(2)
+        return data
+
+    async def _read_some(self, amt):
+        if self.chunked:
+            return await self._read_chunked(amt)
+        elif self.length is not None:
+            data = await self.reader.read(self.length if amt < 0 else min(amt, self.length))
+            if not data:
+                raise http.client.IncompleteRead(data, self.length)
+            self.length -= len(data)
+            if not self.length:
+                self._finish()
+            return data
+        data = await self.reader.read(amt)
+        if not data:
+            # body ends with the connection
+            self.will_close = True
+            self._finish()
+        return data
+
+    async def read(self, amt=-1):
+        """
+        reads at most amt bytes, or the whole body if amt is negative
+        """
+        if self._done:
+            return b''
+        try:
+            if amt >= 0:
+                return await self._read_some(amt)
+            parts = list()
+            while not self._done:
+                parts.append(await self._read_some(-1))
+            return b''.join(parts)
+        except BaseException:
+            # cancelled or broken in the middle, the connection is useless
+            self.abort()
+            raise
+
+
+class Response:
+    """
+    synchronous view of an AsyncResponse, works like urllib's response
+    """
+
+    def __init__(self, engine, url, response):
+        self._engine = engine
+        self._response = response
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = self.msg = response.reason
+        self.headers = response.headers
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=-1):
+        if amt is not None and amt >= 0:
+            return self._engine.call(self._response.read(amt))
+        # timeout applies to every piece like a socket timeout does, a large
+        # body on a slow but alive connection is not cut off
+        parts = list()
+        while True:
+            data = self._engine.call(self._response.read(READ_CHUNK_SIZE))
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    def readline(self):
+        # only to satisfy file wrappers, nobody reads lines of a body here
+        return self.read()
+
+    def close(self):
+        if not self._response._done:
+            self._engine.loop.call_soon_threadsafe(self._response.abort)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncEngine:
+    def __init__(self, timeout=30, max_idle=4, idle_timeout=60, ssl_context=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self._idle = dict()
+        self._stats = {'hits': 0, 'misses': 0}
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='aioweb')
+                thread.daemon = True
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    def stats(self):
+        idle = sum(len(conns) for conns in self._idle.values())
+        return dict(self._stats, idle=idle)
+
+    def _release(self, key, reader, writer):
+        conns = self._idle.setdefault(key, list())
+        if len(conns) >= self.max_idle or reader.at_eof():
+            writer.close()
+            return
+        conns.append((time.time(), reader, writer))
+
+    async def _connect(self, key):
+        conns = self._idle.get(key, list())
+        while conns:
+            since, reader, writer = conns.pop()
+            if time.time() - since <= self.idle_timeout and not reader.at_eof():
+                self._stats['hits'] += 1
+                return reader, writer, True
+            writer.close()
+        self._stats['misses'] += 1
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            context = self.ssl_context or ssl.create_default_context()
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=context, server_hostname=host if context else None
+        )
+        return reader, writer, False
+
+    @staticmethod
+    async def _read_head(reader):
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise http.client.RemoteDisconnected('connection closed without response')
+            lines = list()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise http.client.RemoteDisconnected('connection closed in headers')
+                if line in (b'\r\n', b'\n'):
+                    break
+                lines.append(line)
+            version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            if not version.startswith('HTTP/') or not status.isdigit():
+                raise http.client.BadStatusLine(status_line)
+            # informational responses are followed by the real one
+            if not 100 <= int(status) < 200:
+                headers = http.client.parse_headers(io.BytesIO(b''.join(lines) + b'\r\n'))
+                return version, int(status), reason.strip(), headers
+
+    async def _send(self, key, method, target, headers, body):
+        reader, writer, reused = await self._connect(key)
+        lines = ['{} {} HTTP/1.1'.format(method, target)]
+        lines += ['{}: {}'.format(k, v) for k, v in headers]
+        try:
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            if body:
+                writer.write(body)
+            await writer.drain()
+            version, status, reason, parsed = await self._read_head(reader)
+        except (http.client.RemoteDisconnected, ConnectionError):
+            writer.close()
+            if reused:
+                # the server dropped the idle connection, try a new one
+                return None
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        response = AsyncResponse(self, key, reader, writer, method, status, reason, parsed)
+        if version == 'HTTP/1.0' and parsed.get('Connection', '').lower() != 'keep-alive':
+            response.will_close = True
+        return response
+
+    async def request(self, method, url, headers=None, body=None):
+        """
+        sends one request and returns an AsyncResponse once headers arrive
+        """
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        names = set(k.lower() for k, _ in headers or list())
+        all_headers = list(headers or list())
+        if 'host' not in names:
+            all_headers.insert(0, ('Host', parts.netloc))
+        if 'accept-encoding' not in names:
+            all_headers.append(('Accept-Encoding', 'identity'))
+        if body is not None and 'content-length' not in names:
+            all_headers.append(('Content-Length', str(len(body))))
+        _logger.debug('%s %s, headers %s', method, url, all_headers)
+        response = await self._send(key, method, target, all_headers, body)
+        if response is None:
+            response = await self._send(key, method, target, all_headers, body)
+        return response
+
+    async def _open(self, method, url, headers, body):
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self.request(method, url, headers, body)
+            location = response.headers.get('Location', None)
+            if response.status not in REDIRECT_CODES or not location:
+                return url, response
+            response.abort()
+            url = urljoin(url, location)
+            if response.status == 303 or (response.status in (301, 302) and method == 'POST'):
+                method, body = 'GET', None
+                headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'content-type')]
+            _logger.debug('redirected to %s', url)
+        raise HTTPError(url, response.status, 'too many redirections', response.headers, None)
+
+    def call(self, coro, timeout=None):
+        """
+        runs coro on the shared loop and waits for its result. the
+        coroutine is cancelled if it doesn't finish in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), self.loop)
+        try:
+            return future.result()
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out after {} seconds'.format(timeout))
+
+    def urlopen(self, req):
+        """
+        opens a urllib Request, raises HTTPError for status out of 2xx
+        just like urllib does
+        """
+        url, response = self.call(self._open(
+            req.get_method(), req.full_url, req.header_items(), req.data
+        ))
+        result = Response(self, url, response)
+        if not 200 <= response.status < 300:
+            raise HTTPError(url, response.status, response.reason, response.headers, result)
+        return result
+
+    async def _close_idle(self):
+        for conns in self._idle.values():
+            for _, _, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+    def clear(self):
+        """
+        closes all idle connections
+        """
+        if self._loop is not None:
+            self.call(self._close_idle())
+
+
+_default_engine = None
+
+
+def default_engine():
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = AsyncEngine()
+    return _default_engine
@@ -45,11 +45,12 @@ class PreferHighResolution(HighResolutionSetting):
             webutil.urljoin(rooturl, '_'.join([imgurlbase, suffix + '.jpg']))
             for suffix in resolutions
         ]
-        for url in candidates:
-            _logger.debug('in prefer mode, detect existence of pic %s', url)
-            if webutil.test_header(url):
-                _logger.debug('in prefer mode, decided url: %s', url)
-                return url,
+        _logger.debug('in prefer mode, detect existence of pics %s', candidates)
+        url, timings = webutil.probe_candidates(candidates)
+        _logger.debug('in prefer mode, probing time: %s', timings)
+        if url:
+            _logger.debug('in prefer mode, decided url: %s', url)
+            return url,
         return webutil.urljoin(rooturl, fallbackurl),
 
 
@@ -174,10 +175,12 @@ AssetCollector.register('hdvideo', HdVideoCollector)
 class BingWallpaperPage:
     BASE_URL = 'http://www.bing.com'
     IMAGE_API = '/HPImageArchive.aspx?format=js&mbl=1&idx={idx}&n={n}&video=1'
+    # the archive API returns at most 8 images per call
+    MAX_N = 8
 
     def __init__(self, idx, n=1, base=BASE_URL, api=IMAGE_API, country_code=None,
                  market_code=None, high_resolution=PreferHighResolution, resolution='1920x1200',
-                 collect=None):
+                 collect=None, cache=None):
         self.idx = idx
         self.n = n
         self.base = base
@@ -189,6 +192,7 @@ class BingWallpaperPage:
         self.high_resolution = high_resolution
         self.resolution = resolution
         self.collect = collect or []
+        self.cache = cache
         if market_code:
             BingWallpaperPage.validate_market(market_code)
             self.url = '&'.join([self.url, 'mkt={}'.format(market_code)])
@@ -197,6 +201,9 @@ class BingWallpaperPage:
 
     def reset(self):
         self.__loaded = False
+        self.not_modified = False
+        self.cached = None
+        self.last_start = None
         self.content = ''
         self.__img_link = None
         self.discovered = 0
@@ -214,9 +221,10 @@ class BingWallpaperPage:
         if not self.content:
             return False
 
-        _logger.debug(self.content)
+        log.dump_payload(_logger, self.content, 'archive content', level=log.DEBUG)
 
         self.__images = self.content['images']
+        self.last_start = self._last_start(self.content)
         if 'market' in self.content and 'mkt' in self.content['market']:
             self.act_market = self.content['market']['mkt']
         self._update_img_link()
@@ -225,10 +233,22 @@ class BingWallpaperPage:
 
         return True
 
+    @staticmethod
+    def _last_start(content):
+        # publish time (UTC) of the newest photo in archive
+        try:
+            return max(
+                datetime.strptime(i['fullstartdate'], '%Y%m%d%H%M')
+                for i in content['images']
+            )
+        except Exception:
+            _logger.debug('no publish time found in archive', exc_info=1)
+            return None
+
     def _get_metadata(self, i):
         metadata = dict()
         meta_field = [
-            'copyright', 'copyrightlink', 'hsh'
+            'copyright', 'copyrightlink', 'hsh', 'urlbase'
         ]
         for f in meta_field:
             metadata[f] = i.get(f, None)
@@ -260,14 +280,35 @@ class BingWallpaperPage:
     def load(self):
         self.reset()
         _logger.info('loading from %s', self.url)
-        raw_file = webutil.loadpage(self.url)
-
-        if raw_file:
+        if self.cache:
+            raw_file, self.not_modified = webutil.load_cached(self.url, self.cache)
+            raw_file = raw_file.decode('utf8') if raw_file else None
+        else:
+            raw_file = webutil.loadpage(self.url)
+
+        if self.not_modified:
+            _logger.info('%s is not modified since last loading, skip it', self.url)
+            self.cached = raw_file
+            try:
+                self.last_start = self._last_start(json.loads(raw_file))
+            except (TypeError, ValueError):
+                _logger.debug('can not read cached archive', exc_info=1)
+        elif raw_file:
             _logger.info('%d bytes loaded', len(raw_file))
             self.__loaded = self._parse(raw_file)
         else:
             _logger.error('can\'t download photo page')
 
+    def parse_cached(self):
+        """
+        parse the archive kept in cache by a not modified loading, the page
+        is handled as a modified one after then
+        """
+        _logger.info('process cached archive of %s again', self.url)
+        self.not_modified = False
+        self.__loaded = bool(self.cached) and self._parse(self.cached)
+        return self.__loaded
+
     def loaded(self):
         return self.__loaded
 
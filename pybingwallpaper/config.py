@@ -4,6 +4,7 @@ import codecs
 import io
 import sys
 from argparse import Namespace
+from collections import OrderedDict
 from configparser import ConfigParser
 from copy import copy
 
@@ -32,6 +33,8 @@ class ConfigParameter:
         ConfigParameter is an abstract of configuration data which integrate config file
         and commandline-like argument data models.
     """
+    # one logger shared by all parameters, dozens of them are created at start up
+    logger = log.getChild('ConfigParameter')
 
     def __init__(self, name, defaults=None, type=None, choices=None, help='', loader_srcs=None, loader_opts=None):
         """
@@ -54,7 +57,6 @@ class ConfigParameter:
         loader_opts - options specified as dict will be used by certain loaders
                       read document of loaders for available options
         """
-        self.logger = log.getChild(self.__class__.__name__)
         self.name = str(name)
         self.validate_name()
         self.defaults = defaults if isinstance(defaults, dict) else {'*': defaults}
@@ -114,14 +116,49 @@ class ConfigDatabase:
         self.logger = log.getChild(self.__class__.__name__)
         self.prog = prog
         self.description = description
-        self.parameters = list(parameters) if parameters is not None else list()
+        self.parameters = list()
+        # parameters by name in adding order, and indexes by loader options
+        self._by_name = OrderedDict()
+        self._by_option = dict()
+        if parameters is not None:
+            self.add_params(parameters)
 
     def add_param(self, param):
-        if param not in self.parameters:
+        self.add_params((param,))
+
+    def add_params(self, params):
+        """
+        adds a group of parameters, none of them is added if any name
+        is duplicated
+        """
+        params = list(params)
+        names = set()
+        for param in params:
+            if param.name in self._by_name or param.name in names:
+                raise NameError('duplicated parameter name "%s" found' % (param.name,))
+            names.add(param.name)
+        for param in params:
+            self._by_name[param.name] = param
             self.parameters.append(param)
             self.logger.debug('parameter %s added into config db "%s"', param, self.prog)
-        else:
-            raise NameError('duplicated parameter name "%s" found' % (param.name,))
+        self._by_option.clear()
+
+    def get_param(self, name, default=None):
+        return self._by_name.get(name, default)
+
+    def get_params_by_option(self, loader_key, option_name, value):
+        """
+        returns parameters whose option of loader_key is set to value
+        """
+        key = (loader_key, option_name)
+        if key not in self._by_option:
+            index = dict()
+            for param in self.parameters:
+                opt = param.get_option(loader_key, option_name, None)
+                if opt is not None:
+                    index.setdefault(opt, list()).append(param)
+            self._by_option[key] = index
+        return self._by_option[key].get(value, list())
 
     def __repr__(self):
         return '{}(prog={}, description={}, parameters={})'.format(
@@ -217,22 +254,12 @@ class ConfigFileDumper(ConfigDumper):
     OPT_KEY = 'conffile'
 
     def get_param_by_name(self, db, name):
-        by_key = list(filter(
-            lambda param: name == param.get_option(self.OPT_KEY, 'key', None),
-            db.parameters
-        ))
+        by_key = db.get_params_by_option(self.OPT_KEY, 'key', name)
         if len(by_key) > 1:
             raise ValueError('More than one parameters are set with name {}'.format(name))
         elif len(by_key) == 1:
             return by_key[0]
-
-        by_name = list(filter(lambda param: name == param.name, db.parameters))
-        if len(by_name) > 1:
-            raise ValueError('More than one parameters are set with key {}'.format(name))
-        elif len(by_name) == 1:
-            return by_name[0]
-        else:
-            return None
+        return db.get_param(name)
 
     def dump(self, db, conf, buf, *args, **kwargs):
         parser = ConfigParser()
@@ -353,12 +380,89 @@ def merge_config(config, increment):
     return ans
 
 
-def pretty(config, sep='\n'):
+def pretty(config, sep='\n', sources=None):
     lines = ['{} = {}'.format(str(k), repr(v)) for k, v in config.__dict__.items()]
+    if sources:
+        lines = ['{}  ({})'.format(line, sources.get(k, '?'))
+                 for line, k in zip(lines, config.__dict__.keys())]
     lines.sort()
     return sep.join(lines)
 
 
+class LazyPretty:
+    """
+    formats config with pretty() only when it's converted to str, so that
+    a log record never shown costs nothing
+    """
+
+    def __init__(self, config, sep='\n', sources=None):
+        self.config = config
+        self.sep = sep
+        self.sources = sources
+
+    def __str__(self):
+        return pretty(self.config, self.sep, self.sources)
+
+
+class LayeredConfig:
+    """
+    Resolves config of a database from layers of loaded configs.
+
+    Every key is taken from the first layer having it in LAYERS order, i.e.
+    command line overrides config file which overrides default values.
+    Which layer supplied each value is kept in `sources`. Default and
+    command line layers are loaded once on the first resolving, so that
+    resolving again after the config file changed costs only the file
+    loading.
+    """
+    LAYERS = ('cli', 'file', 'default')
+
+    def __init__(self, db, args, platform=None):
+        self.db = db
+        self.args = args
+        self.platform = platform
+        self.layers = dict()
+        self.sources = dict()
+
+    def _load_fixed_layers(self):
+        self.layers['default'] = DefaultValueLoader(self.platform).load(self.db)
+        _logger.debug('default config:\n\t%s', LazyPretty(self.layers['default'], '\n\t'))
+        self.layers['cli'] = CommandLineArgumentsLoader().load(self.db, self.args)
+        _logger.debug('cli arg parsed:\n\t%s', LazyPretty(self.layers['cli'], '\n\t'))
+
+    def set_layer(self, name, config):
+        """
+        replaces config of layer name, or removes the layer if config is None
+        """
+        if name not in self.LAYERS:
+            raise ValueError('unknown config layer {}'.format(name))
+        if config is None:
+            self.layers.pop(name, None)
+        else:
+            self.layers[name] = config
+
+    def load_file(self, filename, loader=None):
+        self.set_layer('file', from_file(self.db, filename, loader))
+        _logger.debug('config file parsed:\n\t%s', LazyPretty(self.layers['file'], '\n\t'))
+
+    def resolve(self):
+        """
+        returns a new Namespace of resolved config. values are copied so
+        that changing them never touches the layers
+        """
+        if 'default' not in self.layers:
+            self._load_fixed_layers()
+        ans = Namespace()
+        sources = dict()
+        for name in self.LAYERS:
+            for k, v in vars(self.layers.get(name, Namespace())).items():
+                if k not in sources:
+                    sources[k] = name
+                    setattr(ans, k, copy(v))
+        self.sources = sources
+        return ans
+
+
 def to_file(db, config, filename, dumper=None):
     dumper = ConfigFileDumper() if not dumper else dumper
     with codecs.open(filename, 'w', encoding='utf-8') as outf:
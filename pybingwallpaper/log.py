@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
+import itertools
 import logging
+import os
+import tempfile
+import time
 from logging import INFO, DEBUG
 
 # bypass import optimization, levels are meant to be imported for other modules although not used in this file
@@ -11,6 +15,14 @@ logging.addLevelName(PAGEDUMP, 'PAGEDUMP')
 _logger = None
 _children = []
 
+# payloads longer than this (in bytes or characters) are truncated in the log
+# stream and saved completely into a side file
+PAYLOAD_LIMIT = 4096
+# only so many latest side files are kept, older ones are removed
+DUMP_FILES_LIMIT = 50
+_dump_folder = os.path.join(tempfile.gettempdir(), 'bingwallpaper-dump')
+_dump_counter = itertools.count(1)
+
 
 def __init(app_name):
     global _logger
@@ -35,6 +47,84 @@ def setDebugLevel(level):
     list(map(lambda l: l.setLevel(level), _children))
 
 
+def setDumpFolder(folder):
+    """
+    set folder to save large payloads into, None disables side files
+    """
+    global _dump_folder
+    _dump_folder = folder
+
+
+def _save_payload(logger, payload):
+    if not _dump_folder:
+        return None
+    if not os.path.isdir(_dump_folder):
+        os.makedirs(_dump_folder)
+    filename = os.path.join(_dump_folder, '{}-{}-{:06d}.dump'.format(
+        time.strftime('%Y%m%d%H%M%S'), logger.name, next(_dump_counter)
+    ))
+    if isinstance(payload, bytes):
+        with open(filename, 'wb') as outf:
+            outf.write(payload)
+    else:
+        with open(filename, 'w') as outf:
+            outf.write(payload if isinstance(payload, str) else repr(payload))
+    _rotate_dump_folder()
+    return filename
+
+
+def _rotate_dump_folder():
+    # a daemon dumps on every check, don't let side files pile up
+    dumps = [
+        os.path.join(_dump_folder, name) for name in os.listdir(_dump_folder)
+        if name.endswith('.dump')
+    ]
+    if len(dumps) <= DUMP_FILES_LIMIT:
+        return
+    dumps.sort(key=lambda path: (os.path.getmtime(path), path))
+    for path in dumps[:len(dumps) - DUMP_FILES_LIMIT]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def dump_payload(logger, payload, title='payload', level=PAGEDUMP, limit=None):
+    """
+    log payload (page, image, json object etc.) in a lazy and bounded way.
+
+    nothing, not even repr(), is computed unless level is enabled for logger.
+    payloads longer than limit (PAYLOAD_LIMIT by default) are truncated in the
+    log record and saved to a side file under the dump folder instead. side
+    files are written only when PAGEDUMP is enabled, a payload logged at a
+    higher level (e.g. DEBUG) is merely truncated. only the latest
+    DUMP_FILES_LIMIT side files are kept.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    limit = PAYLOAD_LIMIT if limit is None else limit
+    if not isinstance(payload, (bytes, str)):
+        payload = repr(payload)
+    if len(payload) <= limit:
+        logger.log(level, '%s (%d): %r', title, len(payload), payload)
+        return
+    if not logger.isEnabledFor(PAGEDUMP):
+        logger.log(
+            level, '%s (%d, truncated, full content at PAGEDUMP level): %r...',
+            title, len(payload), payload[:limit]
+        )
+        return
+    try:
+        filename = _save_payload(logger, payload)
+    except Exception:
+        logger.warning('can not save payload %s into side file', title, exc_info=1)
+        filename = None
+    logger.log(
+        level, '%s (%d, truncated, full content in %s): %r...',
+        title, len(payload), filename, payload[:limit]
+    )
+
+
 __init('bingwallpaper')
 
 if __name__ == '__main__':
@@ -53,3 +143,15 @@ if __name__ == '__main__':
         __ex_test()
     except Exception as ex:
         log.exception(ex)
+
+    # cost of dumping a 10MB payload while PAGEDUMP is disabled and enabled
+    import timeit
+
+    big_payload = os.urandom(10 * 1024 * 1024)
+    log.setLevel(INFO)
+    cost = timeit.timeit(lambda: dump_payload(log, big_payload), number=1000) / 1000
+    log.info('dump payload at INFO level costs %.9f seconds per call', cost)
+    setDumpFolder(None)
+    log.setLevel(PAGEDUMP)
+    cost = timeit.timeit(lambda: dump_payload(log, big_payload, limit=16), number=1)
+    log.info('dump payload at PAGEDUMP level costs %.9f seconds per call', cost)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import errno
+import hashlib
 import os
 import sched
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from copy import copy
 from datetime import datetime
 from os.path import basename, dirname, abspath
 from os.path import expanduser, join as path_join, isfile, isdir, splitext
@@ -10,8 +14,12 @@ from sys import argv, exit as sys_exit, platform
 from . import bingwallpaper
 from . import config
 from . import log
+from . import pipeline
 from . import record
+from . import scheduler
 from . import setter
+from . import store
+from . import watcher
 from . import webutil
 from .rev import REV
 from .webutil import urlparse, parse_qs
@@ -26,11 +34,21 @@ if platform == 'win32':
         'PyBingWallpaper',
         'bing-wallpaper-history.json'
     )
+    CONTENT_STORE_FILE = path_join(dirname(HISTORY_FILE), 'bing-wallpaper-store.json')
+    METADATA_CACHE_DIR = path_join(dirname(HISTORY_FILE), 'cache')
 else:
     HISTORY_FILE = path_join(expanduser('~'), '.bing-wallpaper-history.json')
+    CONTENT_STORE_FILE = path_join(expanduser('~'), '.bing-wallpaper-store.json')
+    METADATA_CACHE_DIR = path_join(expanduser('~'), '.bing-wallpaper-cache')
 
 _logger = log.getChild('main')
 
+metadata_cache = webutil.HttpCache(METADATA_CACHE_DIR)
+
+BATCH_WORKERS = 4
+
+DOWNLOAD_KEYS = ('size_mode', 'image_size', 'collect', 'output_folder', 'keep_file_name')
+
 
 class CannotLoadImagePage(Exception):
     pass
@@ -147,6 +165,24 @@ def prepare_config_db():
             'section': 'Download',
         }}
     ))
+    params.append(config.ConfigParameter(
+        'markets', defaults=[],
+        help='''download wallpapers of several markets in one run, can be
+            assigned more than once in CLI or as comma separated list from
+            config file. photos shared by markets are downloaded only once.
+            original file names are always kept in this mode.
+            Note: specify this parameter will override --market.
+            ''',
+        loader_opts={'cli': {
+            'flags': ('--markets',),
+            'action': 'append',
+        }, 'conffile': {
+            'formatter': lambda args: ','.join(args),
+            'converter': lambda arg: [_p.strip() for _p in arg.split(',') if
+                                      _p.strip()],
+            'section': 'Download',
+        }}
+    ))
     params.append(config.ConfigParameter(
         'list_markets',
         defaults=False,
@@ -186,6 +222,21 @@ def prepare_config_db():
             'section': 'Daemon',
         }}
     ))
+
+    params.append(config.ConfigParameter(
+        'schedule', defaults='publish',
+        choices=scheduler.PollScheduler.MODES,
+        help='''how the daemon schedules next check. `publish` checks
+                    shortly after the next photo is expected to be published,
+                    falls back to `interval` when the time is unknown, or the
+                    photo is late or not downloaded yet; `interval` checks
+                    every `interval` hours.''',
+        loader_opts={'cli': {
+            'flags': ('--schedule',),
+        }, 'conffile': {
+            'section': 'Daemon',
+        }}
+    ))
     params.append(config.ConfigParameter(
         'keep_file_name', defaults=False,
         help='''keep the original filename. By default
@@ -272,6 +323,32 @@ def prepare_config_db():
             'section': 'Download',
         }}
     ))
+    params.append(config.ConfigParameter(
+        'backfill', type=int, defaults='0',
+        help='''download photos of 'N' days at once, counted backward
+                    from the day specified by --offset. photos which have
+                    been downloaded before are skipped. original file names
+                    are always kept in this mode. 0 (default) disables
+                    backfill.''',
+        loader_opts={'cli': {
+            'flags': ('--backfill',),
+        }, 'conffile': {
+            'section': 'Download',
+        }}
+    ))
+    params.append(config.ConfigParameter(
+        'engine', defaults='urllib',
+        choices=('urllib', 'asyncio'),
+        help='''how requests are sent. `asyncio` serves all requests with
+            one event loop, which scales better when many markets or
+            days are downloaded at once. proxy is supported by `urllib`
+            only.''',
+        loader_opts={'cli': {
+            'flags': ('--engine',),
+        }, 'conffile': {
+            'section': 'Download',
+        }}
+    ))
     params.append(config.ConfigParameter(
         'proxy_server', defaults='',
         help='''proxy server value, ex: http://10.1.1.1''',
@@ -394,6 +471,95 @@ def prepare_config_db():
         }}
     ))
 
+    params.append(config.ConfigParameter(
+        'database_split_images',
+        defaults=False,
+        help='''store images in a table of their own instead of along with
+                    meta info, so that same image is stored only once and
+                    looking up meta info is faster. images stored before are
+                    moved once and the database file is compacted, which can
+                    take a while for a large database.
+                ''',
+        loader_opts={'cli': {
+            'flags': ('--database-split-images',),
+            'action': 'store_true',
+        }, 'conffile': {
+            'section': 'Database',
+            'converter': config.str_to_bool
+        }}
+    ))
+
+    params.append(config.ConfigParameter(
+        'download_workers', type=int, defaults=4,
+        help='''how many files are downloaded at the same time.
+            assets are downloaded along with the photo.''',
+        loader_opts={'cli': {
+            'flags': ('--download-workers',),
+        }, 'conffile': {
+            'section': 'Download',
+        }}
+    ))
+
+    params.append(config.ConfigParameter(
+        'host_connections', type=int, defaults=2,
+        help='''how many files are downloaded from the same host
+            at the same time.''',
+        loader_opts={'cli': {
+            'flags': ('--host-connections',),
+        }, 'conffile': {
+            'section': 'Download',
+        }}
+    ))
+
+    params.append(config.ConfigParameter(
+        'video_segments', type=int, defaults=1,
+        help='''split videos larger than 4MB into so many byte ranges
+            downloaded in parallel. broken video downloads are always
+            resumed next time.''',
+        loader_opts={'cli': {
+            'flags': ('--video-segments',),
+        }, 'conffile': {
+            'section': 'Download',
+        }}
+    ))
+
+    params.append(config.ConfigParameter(
+        'dedup',
+        defaults=False,
+        help='''don't keep duplicated copies of same photo. photos and videos
+                    with same content are hard linked to the file downloaded
+                    before, and stored into database only once.
+                    Note: hard linked files share their content, editing
+                    one of them changes all the others too.
+                ''',
+        loader_opts={'cli': {
+            'flags': ('--dedup',),
+            'action': 'store_true',
+        }, 'conffile': {
+            'section': 'Download',
+            'converter': config.str_to_bool
+        }}
+    ))
+
+    params.append(config.ConfigParameter(
+        'metadata_cache',
+        defaults=True,
+        help='''cache meta data of wallpapers loaded from bing.com and only
+                    check whether it's modified next time, nothing will be
+                    downloaded if not, unless photos saved from it have
+                    been removed or download settings have changed.
+                    use --no-metadata-cache to always load and process
+                    meta data.
+                ''',
+        loader_opts={'cli': {
+            'flags': ('--no-metadata-cache',),
+            'action': 'store_false',
+        }, 'conffile': {
+            'section': 'Download',
+            'converter': config.str_to_bool
+        }}
+    ))
+
     params.append(config.ConfigParameter(
         'server', defaults='global',
         choices=('global', 'china', 'custom'),
@@ -431,8 +597,7 @@ def prepare_config_db():
                                          }}
                                          ))
 
-    for p in params:
-        configdb.add_param(p)
+    configdb.add_params(params)
     return configdb
 
 
@@ -458,105 +623,371 @@ def prepare_output_dir(d):
         _logger.critical('can not access output folder %s', d)
 
 
-def download_wallpaper(run_config):
-    records = list()
-    idx = run_config.offset
-    country_code = None if run_config.country == 'auto' else run_config.country
-    market_code = None if not run_config.market else run_config.market
+def get_base_url(run_config):
     if run_config.server == 'global':
-        base_url = 'http://www.bing.com'
+        return 'http://www.bing.com'
     elif run_config.server == 'china':
-        base_url = 'http://s.cn.bing.net'
+        return 'http://s.cn.bing.net'
     else:
-        base_url = run_config.customserver
+        return run_config.customserver
+
 
+def load_wallpaper_page(run_config, idx, n=1, market=None):
+    country_code = None if run_config.country == 'auto' else run_config.country
+    market_code = market or run_config.market or None
     try:
         s = bingwallpaper.BingWallpaperPage(
-            idx,
-            base=base_url,
+            idx, n,
+            base=get_base_url(run_config),
             country_code=country_code,
             market_code=market_code,
             high_resolution=bingwallpaper.HighResolutionSetting.get_by_name(
                 run_config.size_mode
             ),
             resolution=run_config.image_size,
-            collect=set(run_config.collect)
+            collect=set(run_config.collect),
+            # skip cache when redownloading, it's useless to know nothing changes
+            cache=metadata_cache if run_config.metadata_cache and not run_config.redownload else None,
         )
         _logger.debug(repr(s))
         s.load()
-        _logger.log(log.PAGEDUMP, str(s))
+        log.dump_payload(_logger, s, 'wallpaper page')
     except Exception:
         _logger.fatal('error happened during loading from bing.com.', exc_info=1)
         return None
 
-    if not s.loaded():
+    if s.not_modified and is_processed(run_config, s):
+        scheduler.default_scheduler.observe(market_code, s.last_start)
+        return s
+    elif s.not_modified and not s.parse_cached():
+        _logger.error('can not parse cached %s. aborting...', s.url)
+        invalidate_cache([s])
+        raise CannotLoadImagePage(s)
+    elif not s.loaded():
         _logger.error('can not load url %s. aborting...', s.url)
         raise CannotLoadImagePage(s)
+    return s
+
+
+def download_settings(run_config):
+    # settings deciding which files are saved from an archive
+    settings = dict((k, getattr(run_config, k)) for k in DOWNLOAD_KEYS)
+    settings['collect'] = sorted(settings['collect'])
+    return settings
+
+
+def is_processed(run_config, s):
+    """
+    tells whether a not modified page has been processed with current
+    settings, and the files saved from it are still there
+    """
+    note = s.cache.note(s.url) if s.cache else None
+    if not note or note.get('settings', None) != download_settings(run_config):
+        _logger.info('%s has not been processed with current settings', s.url)
+        return False
+    missing = [f for f in note.get('files', list()) if not isfile(f)]
+    if missing:
+        _logger.info('%s saved from %s have been removed', ', '.join(missing), s.url)
+        return False
+    return True
+
+
+def mark_processed(run_config, s, files):
+    # publish time of the page counts only when its photos are saved or
+    # found in history, or the daemon would sleep till next publish
+    # without today's photo
+    scheduler.default_scheduler.observe(s.market_code, s.last_start)
+    # remember files saved from the page, to know whether it's to be
+    # processed again next time it's not modified
+    if s.cache:
+        s.cache.annotate(s.url, {'settings': download_settings(run_config), 'files': files})
+
+
+def is_downloaded(run_config, mainlink):
+    outfile = get_output_filename(run_config, mainlink)
+    rec = record.default_manager.get_by_url(mainlink)
+    _logger.debug('related download records: %s', rec)
+    if outfile == rec['local_file']:
+        return True
+    elif not run_config.database_file or not run_config.keep_file_name \
+            or not isfile(run_config.database_file):
+        return False
+    # history file keeps only latest photos, while database remembers all.
+    # its records are reliable only when every photo has its own file
+    try:
+        rec = record.SqlDatabaseRecordManager('lookup').find_by_url(run_config.database_file, mainlink)
+    except Exception:
+        _logger.warning('error occurs when look up database %s', run_config.database_file, exc_info=1)
+        return False
+    _logger.debug('related database records: %s', rec)
+    return rec is not None and rec['local_file'] == outfile and isfile(outfile)
+
+
+def download_image(run_config, wplinks, metadata, assets=None):
+    """
+    downloads a photo and starts downloading its assets at the same time.
+
+    futures of asset records are appended to `assets` if given, otherwise
+    they are waited and returned along with the photo record
+    """
+    records = list()
+    mainlink = wplinks[0]
+    copyright_ = metadata['copyright']
+    outfile = get_output_filename(run_config, mainlink)
+    _logger.info('download photo of "%s"', copyright_)
+    # the photo goes first so that it never waits for its assets
+    photo = pipeline.default_pipeline.submit(
+        mainlink, save_a_picture, mainlink, copyright_, outfile,
+        hsh=image_hash_key(metadata, mainlink), dedup=run_config.dedup
+    )
+    asset_futures = collect_assets(wplinks[1:], metadata, run_config)
+    content_hash = photo.result()
+    if not content_hash:
+        for future in asset_futures:
+            future.cancel()
+        return None
+    r = record.DownloadRecord(
+        mainlink, outfile, copyright_,
+        raw=load_raw(run_config, outfile),
+        market=metadata['market'],
+        start_time=metadata['fullstartdate'],
+        end_time=metadata['enddate'],
+        content_hash=content_hash,
+    )
+    records.append(r)
+    if assets is not None:
+        assets += asset_futures
+    else:
+        records += wait_assets(asset_futures)
+    return records
+
+
+def invalidate_cache(pages):
+    # pages must be processed again next time if anything went wrong
+    for s in pages:
+        if s.cache:
+            s.cache.invalidate(s.url)
+
+
+def download_wallpaper(run_config, assets=None):
+    s = load_wallpaper_page(run_config, run_config.offset)
+    if not s:
+        return None
+    elif s.not_modified:
+        _logger.info('nothing new since last check')
+        return None
+
     for wplinks, metadata in s.image_links():
         _logger.debug('%s photo list: %s', metadata, wplinks)
-        mainlink = wplinks[0]
-        copyright_ = metadata['copyright']
-        outfile = get_output_filename(run_config, mainlink)
-        rec = record.default_manager.get_by_url(mainlink)
-        _logger.debug('related download records: %s', rec)
-
-        if outfile == rec['local_file']:
+        if is_downloaded(run_config, wplinks[0]):
             if not run_config.redownload:
                 _logger.info('file has been downloaded before, exit')
+                mark_processed(run_config, s, [get_output_filename(run_config, wplinks[0])])
                 return None
             else:
                 _logger.info('file has been downloaded before, redownload it')
 
-        _logger.info('download photo of "%s"', copyright_)
-        raw = save_a_picture(mainlink, copyright_, outfile)
-        if not raw:
-            continue
-        r = record.DownloadRecord(
-            mainlink, outfile, copyright_,
-            raw=None if run_config.database_no_image else raw,
-            market=metadata['market'],
-            start_time=metadata['fullstartdate'],
-            end_time=metadata['enddate'],
-        )
-        records.append(r)
-        collect_assets(wplinks[1:], metadata, run_config, records)
-        return records
+        records = download_image(run_config, wplinks, metadata, assets)
+        if records:
+            mark_processed(run_config, s, [records[0]['local_file']])
+            return records
 
     _logger.info('bad luck, no wallpaper today:(')
+    invalidate_cache([s])
     return None
 
 
-def collect_assets(wplinks, metadata, run_config, records):
+def load_wallpaper_pages(run_config, markets, days):
+    # fetch the whole range of every market with as few archive calls as
+    # possible, all calls are issued concurrently
+    jobs = list()
+    for market in markets:
+        idx, end = run_config.offset, run_config.offset + days
+        while idx < end:
+            n = min(bingwallpaper.BingWallpaperPage.MAX_N, end - idx)
+            jobs.append((market, idx, n))
+            idx += n
+
+    pages = list()
+    failed = None
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+        futures = [
+            executor.submit(load_wallpaper_page, run_config, idx, n, market)
+            for market, idx, n in jobs
+        ]
+        for (market, idx, n), future in zip(jobs, futures):
+            try:
+                s = future.result()
+            except CannotLoadImagePage as err:
+                _logger.warning('can not load %d photos of market %s since %d days ago',
+                                n, market or 'default', idx)
+                failed = err
+                continue
+            if s:
+                pages.append(s)
+    if failed and not pages:
+        raise failed
+    return pages
+
+
+def batch_download_wallpapers(run_config, assets=None):
+    if not run_config.keep_file_name:
+        _logger.info('original file names are kept when downloading in batch')
+        run_config = copy(run_config)
+        run_config.keep_file_name = True
+
+    markets = run_config.markets or [run_config.market]
+    pages = load_wallpaper_pages(run_config, markets, max(run_config.backfill, 1))
+
+    # markets share a photo with the same hash or url base, group them so
+    # that each photo is downloaded only once
+    groups = OrderedDict()
+    modified = [s for s in pages if not s.not_modified]
+    _logger.debug('%d of %d pages are modified or to be processed again', len(modified), len(pages))
+    for wplinks, metadata in (links for s in modified for links in s.image_links()):
+        group = groups.setdefault(photo_key(metadata), list())
+        if all(wplinks[0] != links[0] for links, _ in group):
+            group.append((wplinks, metadata))
+
+    # file of each photo, downloaded now or before
+    files = dict()
+    tasks = list()
+    for key, group in groups.items():
+        downloaded = next((links[0] for links, _ in group if is_downloaded(run_config, links[0])), None)
+        if downloaded and not run_config.redownload:
+            _logger.info('photo %s has been downloaded before, skip it', group[0][0][0])
+            files[key] = get_output_filename(run_config, downloaded)
+            continue
+        tasks.append((key, group))
+    _logger.info('download %d of %d photos from %d markets',
+                 len(tasks), len(groups), len(markets))
+
+    records = list()
+    if tasks:
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as executor:
+            futures = [
+                executor.submit(download_image, run_config, group[0][0], group[0][1], assets)
+                for _, group in tasks
+            ]
+            # keep the order of archive so that the newest photo comes first
+            for (key, group), future in zip(tasks, futures):
+                group_records = future.result()
+                if not group_records:
+                    continue
+                files[key] = group_records[0]['local_file']
+                records += group_records
+                records += [
+                    shared_record(group_records[0], wplinks[0], metadata)
+                    for wplinks, metadata in group[1:]
+                ]
+    if len(files) < len(groups):
+        invalidate_cache(modified)
+        return records
+    for s in modified:
+        mark_processed(run_config, s, [files[photo_key(metadata)] for _, metadata in s.image_links()])
+    return records
+
+
+def photo_key(metadata):
+    # url base identifies a photo if bing offers no hash of it
+    return metadata['hsh'] or metadata['urlbase']
+
+
+def shared_record(downloaded, url, metadata):
+    # a photo of other markets refers the file downloaded already
+    _logger.debug('%s shares photo %s', url, downloaded['local_file'])
+    return record.DownloadRecord(
+        url, downloaded['local_file'], metadata['copyright'],
+        raw=downloaded['raw'],
+        market=metadata['market'],
+        start_time=metadata['fullstartdate'],
+        end_time=metadata['enddate'],
+        content_hash=downloaded['content_hash'],
+    )
+
+
+def collect_assets(wplinks, metadata, run_config):
+    """
+    starts downloading assets, returns futures of their records
+    """
+    return [
+        pipeline.default_pipeline.submit(link, download_asset, run_config, link, metadata)
+        for link in wplinks
+    ]
+
+
+def download_asset(run_config, link, metadata):
     output_folder = run_config.output_folder
     copyright_ = metadata['copyright']
-    market = metadata['market']
-    for link in wplinks:
-        _logger.debug(
-            'downloading assets of "%s" from %s to %s',
-            copyright_, link, output_folder
+    _logger.debug(
+        'downloading assets of "%s" from %s to %s',
+        copyright_, link, output_folder
+    )
+    filename = get_output_filename(run_config, link)
+    # videos are large, broken downloads of them are resumed next time
+    content_hash = save_a_picture(
+        link, copyright_, filename, optional=True, dedup=run_config.dedup,
+        segments=0 if filename.endswith('jpg') else max(run_config.video_segments, 1)
+    )
+    if not content_hash:
+        return None
+    _logger.info('assets "%s" of "%s" has been downloaded to %s',
+                 link, copyright_, output_folder)
+    if not filename.endswith('jpg'):
+        return None
+    return record.DownloadRecord(
+        link, filename, copyright_,
+        raw=load_raw(run_config, filename),
+        is_accompany=True, market=metadata['market'],
+        content_hash=content_hash,
+    )
+
+
+def wait_assets(futures):
+    # assets are optional, a failed one never fails others
+    return [r for r in pipeline.DownloadPipeline.results(futures) if r]
+
+
+def image_hash_key(metadata, link):
+    # bing offers one hash for all resolutions of a photo
+    if not metadata.get('hsh', None):
+        return None
+    return '{}:{}'.format(metadata['hsh'], link.rsplit('_', 1)[-1])
+
+
+def save_a_picture(pic_url, _, outfile, optional=False, hsh=None, dedup=False, segments=0):
+    """
+    returns SHA-256 hex digest of the saved file, or None on failure.
+
+    a positive `segments` makes the download resumable and splits a large
+    file into so many parallel ranges
+    """
+    if dedup and hsh:
+        digest = store.default_store.reuse(hsh, outfile)
+        if digest:
+            return digest
+    digest = hashlib.sha256()
+    if segments:
+        saved_size = webutil.download_resumable(
+            pic_url, outfile, optional=optional, digest=digest, segments=segments
         )
-        filename = get_output_filename(run_config, link)
-        raw = save_a_picture(link, copyright_, filename, optional=True)
-        if not raw:
-            continue
-        elif filename.endswith('jpg'):
-            r = record.DownloadRecord(
-                link, filename, copyright_,
-                raw=None if run_config.database_no_image else raw,
-                is_accompany=True, market=market
-            )
-            records.append(r)
-        _logger.info('assets "%s" of "%s" has been downloaded to %s',
-                     link, copyright_, output_folder)
+    else:
+        saved_size = webutil.download(pic_url, outfile, optional=optional, digest=digest)
+    if not saved_size:
+        return None
+    _logger.info('file saved %s', outfile)
+    if dedup:
+        store.default_store.add(outfile, digest.hexdigest(), hsh)
+    return digest.hexdigest()
 
 
-def save_a_picture(pic_url, _, outfile, optional=False):
-    picture_content = webutil.loadurl(pic_url, optional=optional)
-    if picture_content:
-        with open(outfile, 'wb') as of:
-            of.write(picture_content)
-            _logger.info('file saved %s', outfile)
-    return picture_content
+def load_raw(run_config, outfile):
+    # image content is only kept in memory when it's going to be embedded
+    # into the database
+    if not run_config.database_file or run_config.database_no_image:
+        return None
+    with open(outfile, 'rb') as inf:
+        return inf.read()
 
 
 def get_output_filename(run_config, link):
@@ -588,27 +1019,55 @@ def load_history():
         f.close()
 
 
+def load_content_store():
+    try:
+        with open(CONTENT_STORE_FILE, 'r') as f:
+            store.default_store.load(f)
+    except IOError as ex:
+        if ex.errno == errno.ENOENT:
+            _logger.debug('%s not found, start with an empty content store', CONTENT_STORE_FILE)
+        else:
+            _logger.warning('error occurs when load content store', exc_info=1)
+
+
+def save_content_store():
+    # never leave a half written store behind
+    tmpfile = CONTENT_STORE_FILE + '.tmp'
+    try:
+        with open(tmpfile, 'w') as f:
+            store.default_store.save(f)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(tmpfile, CONTENT_STORE_FILE)
+    except Exception:
+        _logger.warning('error occurs when save content store', exc_info=1)
+    if store.default_store.bytes_saved:
+        _logger.info('%d bytes of duplicated files are not stored again',
+                     store.default_store.bytes_saved)
+
+
 def save_history(records, run_config, keepold=False):
-    last_record = records[0]
     if not keepold:
         record.default_manager.clear()
-    record.default_manager.add(last_record)
+        record.default_manager.add(records[0])
+    else:
+        for r in records:
+            if not r['is_accompany']:
+                record.default_manager.add(r)
     try:
-        f = open(HISTORY_FILE, 'w')
-        f.truncate(0)
+        record.default_manager.commit(HISTORY_FILE)
     except Exception:
         _logger.warning(
             'error occurs when store downloading history',
             exc_info=1
         )
-    else:
-        record.default_manager.save(f)
-        f.close()
 
     if not run_config.database_file:
         return
 
-    rm = record.SqlDatabaseRecordManager('database %s' % (run_config.database_file,))
+    rm = record.SqlDatabaseRecordManager(
+        'database %s' % (run_config.database_file,), run_config.database_split_images
+    )
     for r in records:
         rm.add(r)
 
@@ -634,40 +1093,148 @@ def set_debug_details(level_number):
     log.setDebugLevel(level)
 
 
-def start(daemon=None):
+class DaemonContext:
+    """
+    states kept across daemon ticks. config, history and content store
+    are loaded again only when their files change, so that a tick costs
+    nothing but the network work. after config is reloaded only the
+    subsystems whose settings changed are set up again.
+    """
+    PROXY_KEYS = frozenset((
+        'proxy_server', 'proxy_port', 'proxy_username', 'proxy_password', 'customserver',
+    ))
+    ENGINE_KEYS = frozenset(('engine', 'proxy_server'))
+
+    def __init__(self, args=None):
+        self.args = argv[1:] if args is None else args
+        self.config_db = prepare_config_db()
+        self.resolver = None
+        self.run_config = None
+        self.config_watcher = None
+        self.wallpaper_setter = None
+        # times config has been loaded again after start, for monitoring
+        self.reloads = 0
+        self.stamps = dict()
+        setter.add_ext_path(dirname(abspath(argv[0])))
+
+    def changed(self, name, path):
+        stamp = watcher.file_stamp(path)
+        if name in self.stamps and self.stamps[name] == stamp:
+            return False
+        self.stamps[name] = stamp
+        return True
+
+    def touch(self, name, path):
+        # files written by ourselves needn't be loaded again
+        self.stamps[name] = watcher.file_stamp(path)
+
+    def refresh(self):
+        if self.run_config is None:
+            prepare_output_dir(dirname(HISTORY_FILE))
+            self.reload_config()
+        elif self.config_watcher.changed():
+            _logger.info('config file %s has been modified, reload it', self.run_config.config_file)
+            self.reload_config()
+        # the folder may be removed since last tick, create it again
+        prepare_output_dir(self.run_config.output_folder)
+        if self.changed('history', HISTORY_FILE):
+            load_history()
+        if self.run_config.dedup and self.changed('store', CONTENT_STORE_FILE):
+            load_content_store()
+        return self.run_config
+
+    @staticmethod
+    def diff(old, new):
+        """
+        returns names of settings differ between two configs
+        """
+        if old is None:
+            return set(vars(new))
+        keys = set(vars(old)) | set(vars(new))
+        return set(k for k in keys if getattr(old, k, None) != getattr(new, k, None))
+
+    def config_file(self):
+        # the file is given by cli or defaults, which never change
+        set_debug_details(self.args.count('--debug') + self.args.count('-d'))
+        self.resolver.set_layer('file', None)
+        return self.resolver.resolve().config_file
+
+    def reload_config(self):
+        if self.resolver is None:
+            self.resolver = config.LayeredConfig(self.config_db, self.args)
+        if self.config_watcher is None:
+            # watch the file before parsing it, so that an edit made
+            # meanwhile is noticed next time
+            self.config_watcher = watcher.watch(self.config_file())
+        else:
+            self.reloads += 1
+        old = self.run_config
+        run_config = load_config(self.config_db, self.args, self.resolver)
+        set_debug_details(run_config.debug)
+        changed = self.diff(old, run_config)
+        if old is not None:
+            _logger.info('config reloaded %d times, changed settings: %s',
+                         self.reloads, ', '.join(sorted(changed)) or 'none')
+
+        if changed & self.PROXY_KEYS:
+            install_proxy(run_config)
+        if changed & self.ENGINE_KEYS:
+            if run_config.engine == 'asyncio' and run_config.proxy_server:
+                _logger.warning('asyncio engine does not support proxy, use urllib instead')
+                webutil.set_engine('urllib')
+            else:
+                webutil.set_engine(run_config.engine)
+        if 'setter' in changed:
+            self.wallpaper_setter = self.select_setter(run_config.setter)
+        if 'database_file' in changed and old is not None and old.database_file:
+            # connection of the former database is useless from now on
+            record.SqlDatabaseRecordManager.close(old.database_file)
+        self.run_config = run_config
+
+    @staticmethod
+    def select_setter(name):
+        if name == 'no':
+            return None
+        try:
+            return setter.get(name)
+        except NameError:
+            _logger.error('unknown wallpaper setter %s', name, exc_info=1)
+            return None
+
+
+def start(daemon=None, context=None):
     if daemon:
         _logger.info('daemon %s triggers an update', str(daemon))
 
-    # reload config again in case the config file has been modified after
-    # last shooting
-    config_db = prepare_config_db()
-    run_config = load_config(config_db)
-    setter.load_ext_setters(dirname(abspath(argv[0])))
+    # config and history are loaded again only if their files have been
+    # modified after last shooting
+    context = context or DaemonContext()
+    run_config = context.refresh()
 
-    prepare_output_dir(run_config.output_folder)
-    prepare_output_dir(dirname(HISTORY_FILE))
-
-    load_history()
-    install_proxy(run_config)
+    poller = scheduler.default_scheduler
+    poller.configure(run_config.schedule, run_config.interval * 3600)
+    pipeline.default_pipeline.configure(run_config.download_workers, run_config.host_connections)
+    assets = list()
     try:
-        file_records = download_wallpaper(run_config)
+        if run_config.backfill > 0 or run_config.markets:
+            file_records = batch_download_wallpapers(run_config, assets)
+        else:
+            file_records = download_wallpaper(run_config, assets)
     except CannotLoadImagePage:
         if not run_config.foreground and run_config.background and daemon:
-            _logger.info("network error happened, daemon will retry in 60 seconds")
-            timeout = 60
+            timeout = poller.failed()
+            _logger.info("network error happened, daemon will retry in %d seconds", timeout)
         else:
             _logger.info("network error happened. please retry after Internet connection restore.")
             timeout = None
         file_records = None
     else:
-        timeout = run_config.interval * 3600
+        timeout = poller.succeeded()
 
-    if file_records:
-        save_history(file_records, run_config)
-    if not file_records or run_config.setter == 'no':
+    if not file_records or context.wallpaper_setter is None:
         _logger.info('nothing to set')
     else:
-        s = setter.get(run_config.setter)()
+        s = context.wallpaper_setter()
         # use the first image as wallpaper, accompanying images are just
         # to fulfill your collection
         wallpaper_record = file_records[0]
@@ -675,40 +1242,55 @@ def start(daemon=None):
         s.set(wallpaper_record['local_file'], run_config.setter_args)
         _logger.info('all done. enjoy your new wallpaper')
 
+    # assets may be still downloading after the wallpaper is set
+    if file_records:
+        file_records += wait_assets(assets)
+    if file_records and run_config.dedup:
+        save_content_store()
+        context.touch('store', CONTENT_STORE_FILE)
+    if file_records:
+        save_history(
+            file_records, run_config,
+            keepold=run_config.backfill > 0 or bool(run_config.markets)
+        )
+        context.touch('history', HISTORY_FILE)
+
     if not run_config.foreground and run_config.background and daemon:
-        schedule_next_poll(timeout, daemon, run_config.interval)
+        schedule_next_poll(timeout, daemon, context)
     elif run_config.foreground:
         _logger.info('force foreground mode from command line')
 
 
-def schedule_next_poll(timeout, daemon, interval):
+def schedule_next_poll(timeout, daemon, context=None):
     if not daemon:
         _logger.error('no scheduler')
     else:
-        _logger.debug('schedule next running in %d seconds', interval * 3600)
-        daemon.enter(timeout, 1, start, (daemon,))
+        _logger.info('schedule next running in %d seconds', timeout)
+        daemon.enter(timeout, 1, start, (daemon, context))
 
 
-def start_daemon():
+def start_daemon(context=None):
     daemon = sched.scheduler()
 
-    start(daemon)
+    start(daemon, context)
     _logger.info('daemon %s is running', str(daemon))
     daemon.run()
     _logger.info('daemon %s exited', str(daemon))
 
 
-def load_config(config_db, args=None):
+def load_config(config_db, args=None, resolver=None):
+    """
+    resolves running config. a resolver kept from the last call saves
+    parsing the command line again
+    """
     args = argv[1:] if args is None else args
     set_debug_details(args.count('--debug') + args.count('-d'))
 
-    default_config = config.DefaultValueLoader().load(config_db)
-    _logger.debug('default config:\n\t%s', config.pretty(default_config, '\n\t'))
-
-    # parse cli options at first because we need the config file path in it
-    cli_config = config.CommandLineArgumentsLoader().load(config_db, argv[1:])
-    _logger.debug('cli arg parsed:\n\t%s', config.pretty(cli_config, '\n\t'))
-    run_config = config.merge_config(default_config, cli_config)
+    if resolver is None:
+        resolver = config.LayeredConfig(config_db, args)
+    # cli options are needed at first for the config file path in it
+    resolver.set_layer('file', None)
+    run_config = resolver.resolve()
 
     if run_config.list_markets:
         list_markets()
@@ -722,22 +1304,19 @@ def load_config(config_db, args=None):
                         config_file)
     else:
         try:
-            conf_config = config.from_file(config_db, run_config.config_file)
+            resolver.load_file(config_file)
         except config.ConfigFileLoader.ConfigValueError as err:
             _logger.error(err)
             sys_exit(1)
+        run_config = resolver.resolve()
 
-        # noinspection PyUnboundLocalVariable
-        _logger.debug('config file parsed:\n\t%s', config.pretty(conf_config, '\n\t'))
-        run_config = config.merge_config(run_config, conf_config)
-
-    # override saved settings again with cli options again, because we want
-    # command line options to take higher priority
-    run_config = config.merge_config(run_config, cli_config)
     if run_config.setter_args:
         run_config.setter_args = ','.join(run_config.setter_args).split(',')
     else:
         run_config.setter_args = list()
+    run_config.markets = [
+        m.strip() for m in ','.join(run_config.markets).split(',') if m.strip()
+    ]
 
     # backward compatibility modifications
     if run_config.size_mode == 'collect':
@@ -748,7 +1327,7 @@ def load_config(config_db, args=None):
         if 'accompany' not in run_config.collect:
             run_config.collect.append('accompany')
 
-    _logger.info('running config is:\n\t%s', config.pretty(run_config, '\n\t'))
+    _logger.info('running config is:\n\t%s', config.LazyPretty(run_config, '\n\t', resolver.sources))
     return run_config
 
 
@@ -772,6 +1351,7 @@ def install_proxy(config):
     from itertools import product
     if not config.proxy_server:
         _logger.debug('no proxy server specified')
+        webutil.remove_proxy()
         return
     else:
         if len(config.proxy_password) <= 4:
@@ -862,13 +1442,17 @@ def list_markets():
 
 
 def main():
-    config_db = prepare_config_db()
-    run_config = load_config(config_db)
-    set_debug_details(run_config.debug)
-    if not run_config.foreground and run_config.background:
-        start_daemon()
-    else:
-        start(None)
+    context = DaemonContext()
+    run_config = context.refresh()
+    try:
+        if not run_config.foreground and run_config.background:
+            start_daemon(context)
+        else:
+            start(None, context)
+    finally:
+        # closing the last connection checkpoints WAL into database file,
+        # otherwise history stays in the -wal file beside it
+        record.SqlDatabaseRecordManager.close_all()
     return 0
 
 
@@ -21,18 +21,44 @@ HTTPConnection = get_moved_attr('httplib', 'http.client', 'HTTPConnection')
 HTTPSConnection = get_moved_attr('httplib', 'http.client', 'HTTPSConnection')
 addinfourl = get_moved_attr('urllib', 'urllib.response', 'addinfourl')
 URLError = get_moved_attr('urllib2', 'urllib.error', 'URLError')
+HTTPError = get_moved_attr('urllib2', 'urllib.error', 'HTTPError')
 
 def debug_output(*args, **kwargs):
     lineno = inspect.currentframe().f_back.f_lineno
     #print("debug at line ", lineno, ": ", *args, **kwargs)
 
+def _host_and_selector(req):
+    # python 3.4 removed the getters of python 2
+    if hasattr(req, 'get_host'):
+        return req.get_host(), req.get_selector()
+    return req.host, req.selector
+
 class AbstractNtlmAuthHandler:
 
-    def __init__(self, password_mgr=None):
+    def __init__(self, password_mgr=None, connect=None):
+        """
+        connect(req) returns a kept-alive connection for req and a callable
+        which gives the connection back once a response on it is done. the
+        authenticated connection then serves later requests without another
+        handshake. without it every handshake is made on a new connection
+        closed after the request
+        """
         if password_mgr is None:
             password_mgr = urllib_request.HTTPPasswordMgr()
         self.passwd = password_mgr
         self.add_password = self.passwd.add_password
+        self.connect = connect
+
+    def open_connection(self, req):
+        if self.connect is not None:
+            return self.connect(req)
+        host, _ = _host_and_selector(req)
+        if not host:
+            raise URLError('no host given')
+        if req.get_full_url().startswith('https://'):
+            return HTTPSConnection(host), None # will parse host:port
+        else:
+            return HTTPConnection(host), None # will parse host:port
 
     def http_error_authentication_required(self, auth_header_field, req, fp, headers):
         auth_header_value_list = headers.get_all(auth_header_field)
@@ -64,21 +90,19 @@ class AbstractNtlmAuthHandler:
                 return None
             headers[self.auth_header] = auth
 
-            host = req.get_host()
-            if not host:
-                raise URLError('no host given')
-            h = None
-            if req.get_full_url().startswith('https://'):
-                h = HTTPSConnection(host) # will parse host:port
-            else:
-                h = HTTPConnection(host) # will parse host:port
+            _, selector = _host_and_selector(req)
+            h, give_back = self.open_connection(req)
             # we must keep the connection because NTLM authenticates the connection, not single requests
             headers["Connection"] = "Keep-Alive"
             headers = dict((name.title(), val) for name, val in list(headers.items()))
-            h.request(req.get_method(), req.get_selector(), req.data, headers)
-            r = h.getresponse()
-            r.begin()
-            r._safe_read(int(r.getheader('content-length')))
+            try:
+                h.request(req.get_method(), selector, req.data, headers)
+                r = h.getresponse()
+                # the challenge body must be drained before the next request
+                r.read()
+            except socket.error as err:
+                h.close()
+                raise URLError(err)
             debug_output('data read')
             try:
                 if r.getheader('set-cookie'):
@@ -88,7 +112,6 @@ class AbstractNtlmAuthHandler:
             except TypeError:
                 debug_output('no cookie')
                 pass
-            r.fp = None # remove the reference to the socket, so that it can not be closed by the response object (we want to keep the socket open)
             auth_header_value = r.getheader(auth_header_field, None)
             debug_output(r.headers)
             debug_output(auth_header_field, ': ', auth_header_value)
@@ -97,19 +120,26 @@ class AbstractNtlmAuthHandler:
             auth = 'NTLM %s' % ntlm.create_NTLM_AUTHENTICATE_MESSAGE(ServerChallenge, UserName, DomainName, pw, NegotiateFlags)
             headers[self.auth_header] = auth
             debug_output('auth ', auth)
-            headers["Connection"] = "Close"
+            # the authenticated connection is kept only if it can be given back
+            headers["Connection"] = "Keep-Alive" if give_back else "Close"
             headers = dict((name.title(), val) for name, val in list(headers.items()))
             try:
-                h.request(req.get_method(), req.get_selector(), req.data, headers)
+                h.request(req.get_method(), selector, req.data, headers)
                 # none of the configured handlers are triggered, for example redirect-responses are not handled!
                 response = h.getresponse()
                 debug_output('data 3 read')
-                def notimplemented():
-                    raise NotImplementedError
-                response.readline = notimplemented
-                return addinfourl(response, response.msg, req.get_full_url())
             except socket.error as err:
+                h.close()
                 raise URLError(err)
+            if give_back:
+                give_back(response)
+            if response.status >= 400:
+                # wrong credentials, don't pass the error page off as content
+                raise HTTPError(req.get_full_url(), response.status, response.reason, response.msg, response)
+            def notimplemented():
+                raise NotImplementedError
+            response.readline = notimplemented
+            return addinfourl(response, response.msg, req.get_full_url(), response.status)
         else:
             return None
 
@@ -125,8 +155,8 @@ class HTTPNtlmAuthHandler(AbstractNtlmAuthHandler, urllib_request.BaseHandler):
 
 class ProxyNtlmAuthHandler(AbstractNtlmAuthHandler, urllib_request.BaseHandler):
     """
-        CAUTION: this class has NOT been tested at all!!!
-        use at your own risk
+        authenticates to a http proxy. tested against a mock proxy only,
+        https requests tunnelled by CONNECT are not supported
     """
     auth_header = 'Proxy-authorization'
     handler_order = 480 # before Digest & Basic auth
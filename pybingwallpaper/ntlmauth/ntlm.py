@@ -220,7 +220,7 @@ def create_NTLM_NEGOTIATE_MESSAGE(user, type1_flags = NTLM_ttype1_FLAGS):
     
 def parse_NTLM_CHALLENGE_MESSAGE(msg2):
     ""
-    msg2 = base64.decodestring(bytes(msg2, 'ascii'))
+    msg2 = base64.b64decode(bytes(msg2, 'ascii'))
     Signature = msg2[0:8]
     msg_ttype = struct.unpack("<I",msg2[8:12])[0]
     assert(msg_ttype==2)
@@ -359,15 +359,15 @@ def calc_resp(password_hash, server_challenge):
     return res
     
 def ComputeResponse(ResponseKeyNT, ResponseKeyLM, ServerChallenge, ServerName, ClientChallenge='\xaa'*8, Time='\0'*8):
-    LmChallengeResponse = hmac.new(ResponseKeyLM, ServerChallenge+ClientChallenge).digest() + ClientChallenge
+    LmChallengeResponse = hmac.new(ResponseKeyLM, ServerChallenge+ClientChallenge, 'md5').digest() + ClientChallenge
     
     Responserversion = b'\x01'
     HiResponserversion = b'\x01'
     temp = Responserversion + HiResponserversion + b'\0'*6 + Time + ClientChallenge + b'\0'*4 + ServerChallenge + b'\0'*4 
-    NTProofStr  = hmac.new(ResponseKeyNT, ServerChallenge + temp).digest()
+    NTProofStr  = hmac.new(ResponseKeyNT, ServerChallenge + temp, 'md5').digest()
     NtChallengeResponse = NTProofStr + temp
     
-    SessionBaseKey = hmac.new(ResponseKeyNT, NTProofStr).digest()
+    SessionBaseKey = hmac.new(ResponseKeyNT, NTProofStr, 'md5').digest()
     return (NtChallengeResponse, LmChallengeResponse)
 
 def ntlm2sr_calc_resp(ResponseKeyNT, ServerChallenge, ClientChallenge=b'\xaa'*8):
@@ -401,24 +401,61 @@ def create_LM_hashed_password_v1(passwd):
 
     return res
     
+def _md4_rotl(x, n):
+    x &= 0xffffffff
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+def _md4_pure(data):
+    "MD4 digest as in RFC 1320"
+    msg = bytearray(data)
+    msg.append(0x80)
+    while len(msg) % 64 != 56:
+        msg.append(0)
+    msg += struct.pack('<Q', (8 * len(data)) & 0xffffffffffffffff)
+    h = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    rounds = (
+        (lambda x, y, z: (x & y) | (~x & z), 0,
+         range(16), (3, 7, 11, 19)),
+        (lambda x, y, z: (x & y) | (x & z) | (y & z), 0x5a827999,
+         (0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15), (3, 5, 9, 13)),
+        (lambda x, y, z: x ^ y ^ z, 0x6ed9eba1,
+         (0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15), (3, 9, 11, 15)),
+    )
+    for offset in range(0, len(msg), 64):
+        x = struct.unpack('<16I', bytes(msg[offset:offset + 64]))
+        a, b, c, d = h
+        for f, const, order, shifts in rounds:
+            for i, k in enumerate(order):
+                a = _md4_rotl(a + f(b, c, d) + x[k] + const, shifts[i % 4])
+                a, b, c, d = d, a, b, c
+        h = [(v + n) & 0xffffffff for v, n in zip(h, (a, b, c, d))]
+    return struct.pack('<4I', *h)
+
+def md4(data):
+    try:
+        return hashlib.new('md4', data).digest()
+    except ValueError:
+        # openssl 3 doesn't offer md4 by default any more
+        return _md4_pure(data)
+
 def create_NT_hashed_password_v1(passwd, user=None, domain=None):
     "create NT hashed password"
     # if the passwd provided is already a hash, we just return the second half
     if re.match(r'^[\w]{32}:[\w]{32}$',passwd):
         return binascii.unhexlify(passwd.split(':')[1])
         
-    digest = hashlib.new('md4', passwd.encode('utf-16le')).digest()
+    digest = md4(passwd.encode('utf-16le'))
     return digest
 
 def create_NT_hashed_password_v2(passwd, user, domain):
     "create NT hashed password"
     digest = create_NT_hashed_password_v1(passwd)
     
-    return hmac.new(digest, (user.upper()+domain).encode('utf-16le')).digest()
+    return hmac.new(digest, (user.upper()+domain).encode('utf-16le'), 'md5').digest()
     return digest
     
 def create_sessionbasekey(password):
-    return hashlib.new('md4', create_NT_hashed_password_v1(password)).digest()
+    return md4(create_NT_hashed_password_v1(password))
 
 if __name__ == "__main__":
     from binascii import unhexlify, hexlify
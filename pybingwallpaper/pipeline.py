@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+
+from . import log
+from .webutil import urlparse
+
+_logger = log.getChild('pipeline')
+
+
+class DownloadPipeline:
+    """
+    Run downloads on a bounded pool of workers.
+
+    At most `per_host` downloads talk to the same host at the same time.
+    Others of a busy host wait in its own queue rather than in the pool,
+    so that they never hold a worker which a download from another host
+    could use.
+    """
+
+    def __init__(self, max_workers=4, per_host=2):
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self._executor = None
+        self._running = dict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_workers, per_host):
+        with self._lock:
+            if max_workers != self.max_workers and self._executor:
+                # running downloads finish in the old pool
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self.max_workers = max_workers
+            self.per_host = per_host
+            for host in list(self._pending):
+                self._fill(host)
+
+    def _fill(self, host):
+        # start pending downloads of host while it has free slots, must be
+        # called with lock held
+        queue = self._pending.get(host, None)
+        while queue and self._running.get(host, 0) < self.per_host:
+            task = queue.popleft()
+            if not task[0].set_running_or_notify_cancel():
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._running[host] = self._running.get(host, 0) + 1
+            self._executor.submit(self._run, host, *task)
+        if not queue:
+            self._pending.pop(host, None)
+
+    def _discard(self, host, future):
+        # a download cancelled before it starts is dropped from queue at
+        # once, so that waiters needn't wait till its turn
+        if not future.cancelled():
+            return
+        with self._lock:
+            queue = self._pending.get(host, ())
+            task = next((t for t in queue if t[0] is future), None)
+            if task is None:
+                return
+            queue.remove(task)
+        future.set_running_or_notify_cancel()
+
+    def _run(self, host, future, url, fn, args, kwargs):
+        try:
+            _logger.debug('start downloading %s', url)
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+        finally:
+            with self._lock:
+                self._running[host] -= 1
+                self._fill(host)
+
+    def submit(self, url, fn, *args, **kwargs):
+        host = urlparse(url).netloc
+        future = Future()
+        future.add_done_callback(lambda f: self._discard(host, f))
+        with self._lock:
+            self._pending.setdefault(host, deque()).append((future, url, fn, args, kwargs))
+            self._fill(host)
+        return future
+
+    @staticmethod
+    def results(futures):
+        """
+        yields results in the order downloads complete. failed or
+        cancelled downloads are logged and skipped
+        """
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                yield future.result()
+            except Exception:
+                _logger.warning('error occurs in download pipeline', exc_info=1)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pending, self._pending = self._pending, dict()
+        for queue in pending.values():
+            for task in queue:
+                task[0].cancel()
+                task[0].set_running_or_notify_cancel()
+        if executor:
+            executor.shutdown(wait=wait)
+
+
+default_pipeline = DownloadPipeline()
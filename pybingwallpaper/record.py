@@ -1,89 +1,272 @@
 #!/usr/bin/env python3
 import datetime
+import hashlib
 import json
-import sqlite3
+import os
+import threading
+from copy import copy
 from os.path import isfile
 
 from . import log
 
 try:
-    from collections import UserDict
+    from collections.abc import MutableMapping
 except ImportError:
-    UserDict = dict
+    from collections import MutableMapping
 
 _logger = log.getChild('record')
 
 
 # _logger.setLevel(log.DEBUG)
 
-class DownloadRecord(UserDict):
+class DownloadRecord(MutableMapping):
+    """
+    Download record accessed like a dict of FIELDS.
+
+    Values live in slots instead of a dict per record, times are kept as
+    datetime and formatted only when read, and raw image content is held
+    by reference.
+    """
+    FIELDS = (
+        'url', 'local_file', 'description', 'time', 'start_time', 'end_time',
+        'raw', 'is_accompany', 'market', 'content_hash',
+    )
+    __slots__ = FIELDS
+    _field_set = frozenset(FIELDS)
+
     def __init__(
             self, url, local_file, description,
-            download_time=None, start_time=None, end_time=None, raw=None, is_accompany=False, market=''
+            download_time=None, start_time=None, end_time=None, raw=None, is_accompany=False, market='',
+            content_hash=None
     ):
-        UserDict.__init__(self)
         if download_time is None:
             download_time = datetime.datetime.utcnow()
-        timestr = download_time.isoformat()
 
-        self['url'] = url
-        self['local_file'] = local_file
-        self['description'] = description
-        self['time'] = timestr
-        self['start_time'] = start_time.isoformat() if start_time else None
-        self['end_time'] = end_time.isoformat() if end_time else None
-        self['raw'] = raw
-        self['is_accompany'] = is_accompany
-        self['market'] = market
+        self.url = url
+        self.local_file = local_file
+        self.description = description
+        self.time = download_time
+        self.start_time = start_time or None
+        self.end_time = end_time or None
+        self.raw = raw
+        self.is_accompany = is_accompany
+        self.market = market
+        self.content_hash = content_hash
+
+    @classmethod
+    def from_dict(cls, d):
+        r = cls.__new__(cls)
+        for k, v in d.items():
+            if k in cls._field_set:
+                setattr(r, k, v)
+        return r
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError('{} is not a field of download record'.format(key))
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        for k in self.FIELDS:
+            if hasattr(self, k):
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __copy__(self):
+        return self.from_dict(dict((k, getattr(self, k)) for k in self.FIELDS if hasattr(self, k)))
+
+    copy = __copy__
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self))
 
 
 null_record = DownloadRecord('', '', 'Null Record', datetime.datetime.utcfromtimestamp(0))
 
 
 class DownloadRecordManager(dict):
+    """
+    Download history kept in an append-only journal of JSON lines.
+
+    Every line is either a record, or an operation `{"op": "clear"}`
+    which forgets all records before it. Records whose file has been
+    removed are dropped when looked up. Changes made by add() and clear()
+    are appended by commit(), and the journal is compacted into live
+    records only when it has grown much larger than them. A line broken
+    by a crash is skipped when loading. The history file of older
+    versions, a single JSON object of all records, is loaded as well.
+    """
+    # compact the journal once it holds so many times more entries than
+    # live records, but never for a tiny journal
+    COMPACT_RATIO = 2
+    COMPACT_MIN = 64
+
     def __init__(self, name):
         dict.__init__(self)
         self.name = name
-        self.clear()
+        # entries in journal file, and those not written yet
+        self.entries = 0
+        self.pending = list()
 
-    def save(self, f):
-        json.dump(self, f)
+    def _load_entry(self, entry):
+        if entry.get('op', None) == 'clear':
+            dict.clear(self)
+        elif 'url' in entry:
+            self[entry['url']] = DownloadRecord.from_dict(entry)
+        else:
+            # legacy history file of all records
+            for r in entry.values():
+                self[r['url']] = DownloadRecord.from_dict(r)
 
-    def load(self, f):
-        self.clear()
+    @staticmethod
+    def _exists(r):
         try:
-            content = json.load(f)
+            return isfile(r['local_file'])
         except Exception:
-            _logger.warning('error occurs when load json file', exc_info=1)
-            return
-        _logger.debug('json file loaded:\n%s', str(content))
-        for r in content.values():
+            _logger.debug('error occurs when detecting saved file', exc_info=1)
+            return False
+
+    def save(self, f):
+        """
+        writes all live records into f as a compacted journal
+        """
+        for r in self.values():
+            f.write(json.dumps(dict(r)) + '\n')
+        self.entries = len(self)
+        del self.pending[:]
+
+    def load(self, f):
+        dict.clear(self)
+        del self.pending[:]
+        self.entries = 0
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
             try:
-                exists = isfile(r['local_file'])
-            except Exception:
-                _logger.debug('error occurs when detecting saved file', exc_info=1)
-                exists = False
-            if exists:
-                self.add(r)
-            else:
-                _logger.debug('%s doesn\'t exist any more', r)
-        _logger.debug('history %s loaded', self)
+                entry = json.loads(line)
+            except ValueError:
+                _logger.warning('broken line %d in history %s is skipped', lineno, self.name)
+                continue
+            self.entries += 1
+            self._load_entry(entry)
+        _logger.debug('history %s loaded from %d entries', self, self.entries)
+
+    def clear(self):
+        dict.clear(self)
+        self.pending = [{'op': 'clear'}]
 
     def add(self, r):
-        r = dict(r)
-        if 'raw' in r:
-            r.pop('raw')
+        r = copy(r)
+        r.pop('raw', None)
         self[r['url']] = r
+        self.pending.append(r)
 
     def get_by_url(self, url, default_rec=null_record):
-        return self.get(url, default_rec)
+        """
+        returns record of url if its file still exists. files are checked
+        here rather than on loading, so that a large history on a slow
+        disk costs only the lookups actually made
+        """
+        r = self.get(url, None)
+        if r is None:
+            return default_rec
+        elif not self._exists(r):
+            _logger.debug('%s doesn\'t exist any more', r)
+            self.pop(url, None)
+            return default_rec
+        return r
+
+    def commit(self, filename):
+        """
+        writes changes since last load or commit into journal filename
+        """
+        if not self.pending:
+            return
+        if self.entries + len(self.pending) > max(self.COMPACT_RATIO * len(self), self.COMPACT_MIN):
+            self.compact(filename)
+            return
+        with open(filename, 'ab+') as f:
+            f.seek(0, os.SEEK_END)
+            lines = ''.join(json.dumps(dict(entry)) + '\n' for entry in self.pending)
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # a crash cut the last line, never glue to it
+                    lines = '\n' + lines
+            f.write(lines.encode('utf8'))
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries += len(self.pending)
+        del self.pending[:]
+
+    def compact(self, filename):
+        """
+        replaces journal filename with live records atomically
+        """
+        _logger.debug('compact history %s of %d entries into %d records',
+                      filename, self.entries + len(self.pending), len(self))
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            self.save(f)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, 'replace', os.rename)(tmpfile, filename)
 
 
 default_manager = DownloadRecordManager('default')
 
 
+def sha256(data):
+    if data is None:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+INDEX_SCRIPT = '''
+    CREATE INDEX IF NOT EXISTS [BingWallpaperRecords_Market] ON [BingWallpaperRecords] (Market);
+    CREATE INDEX IF NOT EXISTS [BingWallpaperRecords_StartTime] ON [BingWallpaperRecords] (StartTime);
+    CREATE INDEX IF NOT EXISTS [BingWallpaperRecords_ContentHash] ON [BingWallpaperRecords] (ContentHash);
+'''
+
+
 class SqlDatabaseRecordManager(DownloadRecordManager):
-    LATEST_DB_VERSION = (5, 6, 1)
+    PRAGMAS = (
+        # page size takes effect only before any table is created
+        ('page_size', 16384),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        # negative value is in KiB
+        ('cache_size', -16384),
+    )
+    # connections are kept open across daemon cycles, version of a
+    # database is checked once when it's connected
+    _connections = dict()
+    _lock = threading.RLock()
+    # databases whose embedded images have been moved since connected
+    _split = set()
+
+    LATEST_DB_VERSION = (5, 9, 0)
     DB_UPGRADE_SCRIPTS = {
         # from_ver:  (to_ver, sql)
         (4, 4, 1): ((4, 4, 2), '''
@@ -108,30 +291,240 @@ class SqlDatabaseRecordManager(DownloadRecordManager):
             UPDATE [BingWallpaperCore]
               SET (MajorVer, MinorVer, Build) = (5, 6, 1)
               WHERE MajorVer=4 AND MinorVer=4 AND Build=2;
-        ''')
+        '''),
+
+        (5, 6, 1): ((5, 7, 0), '''
+            ALTER TABLE [BingWallpaperRecords]
+            ADD COLUMN ContentHash CHAR(64) DEFAULT NULL;
+
+            UPDATE [BingWallpaperCore]
+              SET (MajorVer, MinorVer, Build) = (5, 7, 0)
+              WHERE MajorVer=5 AND MinorVer=6 AND Build=1;
+        '''),
+
+        # images are moved into this table only if split_images is
+        # enabled, existing records are left as they are
+        (5, 7, 0): ((5, 8, 0), '''
+            CREATE TABLE [BingWallpaperImages] (
+              [ContentHash] CHAR(64) NOT NULL PRIMARY KEY,
+              [Image] BLOB NOT NULL);
+
+            UPDATE [BingWallpaperCore]
+              SET (MajorVer, MinorVer, Build) = (5, 8, 0)
+              WHERE MajorVer=5 AND MinorVer=7 AND Build=0;
+        '''),
+
+        (5, 8, 0): ((5, 9, 0), INDEX_SCRIPT + '''
+            UPDATE [BingWallpaperCore]
+              SET (MajorVer, MinorVer, Build) = (5, 9, 0)
+              WHERE MajorVer=5 AND MinorVer=8 AND Build=0;
+        '''),
     }
 
+    # statements are kept constant so that sqlite3 reuses them from its
+    # prepared statement cache
+    COLUMNS = '''
+        Url, LocalFilePath, Description, DownloadTime, StartTime, EndTime, IsAccompany, Market, ContentHash
+    '''
+    SELECT_BY_URL = 'SELECT' + COLUMNS + 'FROM [BingWallpaperRecords] WHERE Url=?'
+    SELECT_ALL = 'SELECT' + COLUMNS + 'FROM [BingWallpaperRecords]'
+    SELECT_RANGE = 'SELECT' + COLUMNS + '''FROM [BingWallpaperRecords]
+        WHERE StartTime>=:since AND StartTime<:until
+          AND (:market IS NULL OR Market=:market)
+          AND (:accompany OR NOT IsAccompany)
+        ORDER BY StartTime DESC LIMIT :limit
+    '''
+
+    # moves images embedded in records into their own table, one copy for
+    # each content hash
+    SPLIT_IMAGES_SCRIPT = (
+        '''
+        UPDATE [BingWallpaperRecords]
+          SET ContentHash = sha256(Image)
+          WHERE ContentHash IS NULL AND Image IS NOT NULL
+        ''',
+        '''
+        INSERT OR IGNORE INTO [BingWallpaperImages] (ContentHash, Image)
+          SELECT ContentHash, Image FROM [BingWallpaperRecords]
+          WHERE Image IS NOT NULL
+        ''',
+        '''
+        UPDATE [BingWallpaperRecords] SET Image = NULL WHERE Image IS NOT NULL
+        ''',
+    )
+
+    def __init__(self, name, split_images=False):
+        DownloadRecordManager.__init__(self, name)
+        # keep images in BingWallpaperImages instead of the Image column of
+        # records, so that metadata queries never page through them and a
+        # same image is stored once
+        self.split_images = split_images
+
     def add(self, r):
         self[r['url']] = r
 
+    def connect(self, f):
+        with self._lock:
+            conn = self._connections.get(f, None)
+            if conn is not None and isfile(f):
+                return conn
+            elif conn is not None:
+                _logger.info('database %s has been removed, create it again', f)
+                conn.close()
+            import sqlite3
+            conn = sqlite3.connect(f, check_same_thread=False)
+            conn.create_function('sha256', 1, sha256)
+            for name, value in self.PRAGMAS:
+                conn.execute('PRAGMA {}={}'.format(name, value))
+            _logger.debug('database %s is in %s mode', f, conn.execute('PRAGMA journal_mode').fetchone()[0])
+            self.upgrade_db(conn)
+            self._connections[f] = conn
+            return conn
+
+    @classmethod
+    def close(cls, f):
+        with cls._lock:
+            conn = cls._connections.pop(f, None)
+            cls._split.discard(f)
+            if conn is not None:
+                conn.close()
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for conn in cls._connections.values():
+                conn.close()
+            cls._connections.clear()
+            cls._split.clear()
+
+    def _move_images(self, f, conn):
+        """
+        moves images embedded in records of database f into
+        BingWallpaperImages, then vacuums the database to give the freed
+        space back. done once after f is connected
+        """
+        with self._lock:
+            if f in self._split:
+                return
+            with conn:
+                moved = conn.execute('''
+                    SELECT count(*) FROM [BingWallpaperRecords] WHERE Image IS NOT NULL
+                ''').fetchone()[0]
+                for sql in self.SPLIT_IMAGES_SCRIPT if moved else ():
+                    conn.execute(sql)
+            if moved:
+                conn.execute('VACUUM')
+                _logger.info('%d images moved out of records of %s', moved, f)
+            self._split.add(f)
+
     def save(self, f):
         _logger.info('trying to save history to %s', f)
-        conn = sqlite3.connect(f)
-        self.upgrade_db(conn)
-        cur = conn.cursor()
-        for k, v in self.items():
-            cur.execute('''
+        conn = self.connect(f)
+        if self.split_images:
+            self._move_images(f, conn)
+        bytes_saved = 0
+        rows = list()
+        images = dict()
+        with self._lock, conn:
+            cur = conn.cursor()
+            for k, v in self.items():
+                raw = v.get('raw', None)
+                content_hash = v.get('content_hash', None)
+                if raw and not content_hash:
+                    content_hash = sha256(raw)
+                image = None
+                if not raw:
+                    pass
+                elif not self.split_images:
+                    image = raw
+                elif content_hash in images or self.image_stored(cur, content_hash):
+                    # same image has been saved by another record, refer it by hash
+                    bytes_saved += len(raw)
+                else:
+                    images[content_hash] = raw
+                rows.append((
+                    k, v['time'], v['start_time'], v['end_time'], v['local_file'], v['description'],
+                    image, v['is_accompany'], v['market'], content_hash
+                ))
+            cur.executemany('''
                 INSERT OR REPLACE INTO [BingWallpaperRecords]
-                  (Url, DownloadTime, StartTime, EndTime, LocalFilePath, Description, Image, IsAccompany, Market)
-                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                k, v['time'], v['start_time'], v['end_time'], v['local_file'], v['description'], v['raw'],
-                v['is_accompany'], v['market']
-            ))
-        conn.commit()
+                  (Url, DownloadTime, StartTime, EndTime, LocalFilePath, Description, Image, IsAccompany,
+                   Market, ContentHash)
+                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            cur.executemany('''
+                INSERT OR IGNORE INTO [BingWallpaperImages] (ContentHash, Image) VALUES (?, ?)
+            ''', images.items())
+        _logger.debug('%d records and %d images saved in one transaction', len(rows), len(images))
+        if bytes_saved:
+            _logger.info('%d bytes of duplicated images are not saved into database', bytes_saved)
+
+    @staticmethod
+    def image_stored(cur, content_hash):
+        return cur.execute('''
+            SELECT 1 FROM [BingWallpaperImages] WHERE ContentHash=?
+        ''', (content_hash,)).fetchone() is not None
+
+    def load_image(self, f, content_hash):
+        """
+        returns content of the image, or None if it's not stored
+        """
+        conn = self.connect(f)
+        with self._lock:
+            # images not split yet are embedded in records
+            row = conn.execute('''
+                SELECT Image FROM [BingWallpaperImages] WHERE ContentHash=:hash
+                UNION ALL
+                SELECT Image FROM [BingWallpaperRecords] WHERE ContentHash=:hash AND Image IS NOT NULL
+                LIMIT 1
+            ''', {'hash': content_hash}).fetchone()
+        return bytes(row[0]) if row else None
+
+    @staticmethod
+    def _to_record(row):
+        return DownloadRecord.from_dict({
+            'url': row[0], 'local_file': row[1], 'description': row[2],
+            'time': row[3], 'start_time': row[4], 'end_time': row[5],
+            'is_accompany': bool(row[6]), 'market': row[7], 'content_hash': row[8],
+        })
+
+    def _fetch(self, f, sql, params=()):
+        conn = self.connect(f)
+        with self._lock:
+            return [self._to_record(row) for row in conn.execute(sql, params)]
+
+    def get_by_url(self, url, default_rec=null_record):
+        return self.get(url, default_rec)
 
     def load(self, f):
-        raise NotImplementedError("sql database is write-only")
+        """
+        loads all records (without images) from database f
+        """
+        dict.clear(self)
+        for r in self._fetch(f, self.SELECT_ALL):
+            self[r['url']] = r
+        _logger.debug('%d records loaded from database %s', len(self), f)
+
+    def find_by_url(self, f, url):
+        """
+        looks up a record of database f by url, returns None if not found
+        """
+        records = self._fetch(f, self.SELECT_BY_URL, (url,))
+        return records[0] if records else None
+
+    def query(self, f, since=None, until=None, market=None, accompany=False, limit=-1):
+        """
+        records of database f started in [since, until) and optionally of
+        given market, the latest first. since and until are datetime or
+        date objects
+        """
+        return self._fetch(f, self.SELECT_RANGE, {
+            'since': since.isoformat() if since else '',
+            'until': until.isoformat() if until else '\uffff',
+            'market': market,
+            'accompany': accompany,
+            'limit': limit,
+        })
 
     def upgrade_db(self, conn):
         ver = self.judge_version(conn)
@@ -170,8 +563,15 @@ class SqlDatabaseRecordManager(DownloadRecordManager):
               [Market] TEXT(64) DEFAULT "",
               [Image] BLOB,
               [IsAccompany] BOOLEAN DEFAULT False,
+              [ContentHash] CHAR(64) DEFAULT NULL,
               CONSTRAINT [sqlite_autoindex_BingWallpaperRecords_1] PRIMARY KEY ([Url]));
         ''')
+        cur.execute('''
+            CREATE TABLE [BingWallpaperImages] (
+              [ContentHash] CHAR(64) NOT NULL PRIMARY KEY,
+              [Image] BLOB NOT NULL);
+        ''')
+        cur.executescript(INDEX_SCRIPT)
         cur.execute('''
             CREATE TABLE [BingWallpaperCore] (
               [MajorVer] INTEGER,
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import random
+from datetime import datetime, timedelta
+
+from . import log
+
+_logger = log.getChild('scheduler')
+
+
+class PollScheduler:
+    """
+    Decide how long the daemon sleeps before checking bing.com again.
+
+    Bing publishes a new photo per market once a day and the archive tells
+    when the current one was published (`fullstartdate`, in UTC). In
+    `publish` mode the daemon sleeps until the next photo is expected
+    and checks again shortly after that, instead of polling every
+    `interval`. Network errors are retried with exponential backoff.
+    """
+    MODES = ('publish', 'interval')
+    PUBLISH_PERIOD = timedelta(days=1)
+    # wait a bit more after the expected publish time, bing doesn't
+    # update all servers at the same second
+    JITTER = 300
+    # first retry after a network error or a late photo, doubled every
+    # time it fails again
+    RETRY = 60
+    LATE_RETRY = 600
+    MAX_RETRY = 3600
+
+    def __init__(self, mode='publish', interval=7200, clock=datetime.utcnow, rand=random.uniform):
+        self.mode = mode
+        self.interval = interval
+        self.clock = clock
+        self.rand = rand
+        self.last_start = dict()
+        self.failures = 0
+        self.late = 0
+
+    def configure(self, mode, interval):
+        if mode not in self.MODES:
+            raise ValueError('unknown schedule mode {}'.format(mode))
+        self.mode = mode
+        self.interval = interval
+
+    def observe(self, market, start_time):
+        if not start_time:
+            return
+        last = self.last_start.get(market, None)
+        if not last or start_time > last:
+            _logger.debug('photo of market %s was published at %s', market or 'default', start_time)
+            self.last_start[market] = start_time
+
+    def next_publish(self):
+        if not self.last_start:
+            return None
+        return min(self.last_start.values()) + self.PUBLISH_PERIOD
+
+    def _backoff(self, base, times):
+        delay = min(base * 2 ** max(times - 1, 0), max(self.MAX_RETRY, base))
+        return delay + self.rand(0, delay / 10.0)
+
+    def succeeded(self):
+        """
+        returns seconds to wait after a successful check
+        """
+        self.failures = 0
+        if self.mode == 'interval':
+            return self.interval
+
+        next_publish = self.next_publish()
+        if not next_publish:
+            _logger.debug('publish time unknown, fall back to interval')
+            return self.interval
+
+        wait = (next_publish - self.clock()).total_seconds()
+        if wait > 0:
+            self.late = 0
+            _logger.info('next photo is expected at %s UTC', next_publish)
+            return wait + self.rand(0, self.JITTER)
+
+        # the photo should have been there, check again soon but never
+        # more seldom than the interval
+        self.late += 1
+        _logger.info('photo expected at %s UTC is late', next_publish)
+        return min(self._backoff(self.LATE_RETRY, self.late), self.interval)
+
+    def failed(self):
+        """
+        returns seconds to wait after a failed check
+        """
+        self.failures += 1
+        return self._backoff(self.RETRY, self.failures)
+
+
+default_scheduler = PollScheduler()
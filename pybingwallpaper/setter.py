@@ -67,6 +67,8 @@ class WallpaperSetterFactory:
     def __init__(self, name):
         self.registered = dict()
         self.name = name
+        # folders of ext setters not loaded yet
+        self.ext_paths = list()
 
     def register(self, name, c):
         if name in self.registered \
@@ -75,7 +77,16 @@ class WallpaperSetterFactory:
                 '{} has been registered by {}'.format(name, self.registered[name]))
         self.registered[name] = c
 
+    def add_ext_path(self, path):
+        """
+        ext setters in path are loaded when a setter not registered
+        yet is asked for, so that nobody pays for them unless needed
+        """
+        self.ext_paths.append(path)
+
     def get(self, name):
+        while name not in self.registered and self.ext_paths:
+            load_ext_setters(self.ext_paths.pop(0))
         if name not in self.registered:
             raise NameError(
                 'unregistered setter {}'.format(name))
@@ -100,6 +111,7 @@ _default_wallpaper_factory = WallpaperSetterFactory('default')
 
 register = _default_wallpaper_factory.register
 get = _default_wallpaper_factory.get
+add_ext_path = _default_wallpaper_factory.add_ext_path
 
 if sys.platform.startswith('linux'):
     register('gnome2', Gnome2Setter)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import json
+import os
+import threading
+
+from . import log
+
+_logger = log.getChild('store')
+
+
+class ContentStore:
+    """
+    Content addressed index of downloaded files.
+
+    Files are indexed by SHA-256 of their content and, optionally, by the
+    hash bing.com offers in the archive API (the `hsh` field). A file whose
+    content has been stored before is hard linked to the existing copy
+    instead of keeping another one on disk, so all copies change together
+    if one of them is edited.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.blobs = dict()
+        self.hashes = dict()
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def save(self, f):
+        with self._lock:
+            json.dump({'blobs': self.blobs, 'hashes': self.hashes}, f)
+
+    def load(self, f):
+        try:
+            content = json.load(f)
+        except Exception:
+            _logger.warning('error occurs when load content store', exc_info=1)
+            return
+        with self._lock:
+            self.blobs = content.get('blobs', dict())
+            self.hashes = content.get('hashes', dict())
+        _logger.debug('%d blobs loaded into content store %s', len(self.blobs), self.name)
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, int(st.st_mtime)
+
+    def _valid_blob(self, digest):
+        blob = self.blobs.get(digest, None)
+        if not blob:
+            return None
+        # the file may be removed or overwritten after it was stored
+        if self._stat(blob['path']) != (blob['size'], blob['mtime']):
+            _logger.debug('blob %s of %s is gone', digest, blob['path'])
+            del self.blobs[digest]
+            return None
+        return blob
+
+    def find(self, digest):
+        with self._lock:
+            blob = self._valid_blob(digest)
+            return blob['path'] if blob else None
+
+    def find_by_hash(self, hsh):
+        with self._lock:
+            digest = self.hashes.get(hsh, None)
+            blob = self._valid_blob(digest) if digest else None
+            return (digest, blob['path']) if blob else (None, None)
+
+    @staticmethod
+    def _same_file(src, dst):
+        return os.path.exists(dst) and os.path.samefile(src, dst)
+
+    @classmethod
+    def link(cls, src, dst):
+        """
+        make dst a hard link of src, returns False if the file system
+        doesn't support hard link
+        """
+        if cls._same_file(src, dst):
+            return True
+        tmp = dst + '.link'
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            os.link(src, tmp)
+            replace = getattr(os, 'replace', os.rename)
+            replace(tmp, dst)
+        except (AttributeError, OSError):
+            _logger.debug('can not link %s to %s', src, dst, exc_info=1)
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        return True
+
+    def _count_saved(self, digest):
+        # the blob may be dropped by another thread once the lock is released
+        with self._lock:
+            size = self.blobs.get(digest, dict()).get('size', 0)
+            self.bytes_saved += size
+        return size
+
+    def reuse(self, hsh, outfile):
+        """
+        link outfile to the stored file of hsh, returns its digest or None if
+        it's never been stored
+        """
+        digest, path = self.find_by_hash(hsh)
+        if not path:
+            return None
+        if self._same_file(path, outfile):
+            # linked by an earlier run, nothing more is saved
+            return digest
+        if not self.link(path, outfile):
+            return None
+        self._count_saved(digest)
+        _logger.info('%s has been stored as %s, linked', outfile, path)
+        return digest
+
+    def add(self, outfile, digest, hsh=None):
+        """
+        store outfile with content digest. if the same content has been
+        stored, outfile is replaced by a hard link of the stored one.
+        returns path of the stored file
+        """
+        existing = self.find(digest)
+        with self._lock:
+            if hsh:
+                self.hashes[hsh] = digest
+        if existing and self._same_file(existing, outfile):
+            return existing
+        if existing and self.link(existing, outfile):
+            size = self._count_saved(digest)
+            _logger.info('content of %s is same as %s, %d bytes saved', outfile, existing, size)
+            return existing
+        stat = self._stat(outfile)
+        if stat is None:
+            return None
+        with self._lock:
+            self.blobs[digest] = {'path': os.path.abspath(outfile), 'size': stat[0], 'mtime': stat[1]}
+        return outfile
+
+
+default_store = ContentStore('default')
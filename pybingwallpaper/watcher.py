@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+watches a file for changes. on linux inotify tells whether anything
+happened to the file, so a check normally costs a single non-blocking
+read; elsewhere, or if inotify is unavailable, stat of the file is
+compared.
+"""
+import errno
+import os
+import struct
+import sys
+from os.path import abspath, basename, dirname
+
+from . import log
+
+_logger = log.getChild('watcher')
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+# struct inotify_event without the trailing name
+EVENT = struct.Struct('iIII')
+
+
+def file_stamp(path):
+    # a file replaced or modified gets a different stamp
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino, st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime)
+
+
+class StatWatcher:
+    def __init__(self, path):
+        self.path = path
+        self.stamp = file_stamp(path)
+
+    def changed(self):
+        """
+        tells whether the file changed since creation or last call
+        """
+        stamp = file_stamp(self.path)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(StatWatcher):
+    """
+    watches the folder of the file rather than the file itself, because
+    editors often save by replacing the file with a new one
+    """
+    _libc = None
+
+    def __init__(self, path):
+        StatWatcher.__init__(self, path)
+        self.name = basename(path)
+        self.polling = False
+        # ctypes is loaded only by those who watch
+        import ctypes
+        libc = self.libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        folder = dirname(abspath(path))
+        if libc.inotify_add_watch(self.fd, folder.encode(sys.getfilesystemencoding()), WATCH_MASK) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'can not watch {}'.format(folder))
+        _logger.debug('watch %s with inotify', path)
+
+    @classmethod
+    def libc(cls):
+        if cls._libc is None:
+            import ctypes
+            import ctypes.util
+            cls._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return cls._libc
+
+    def _events(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 4096)
+            except OSError as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            pos = 0
+            while pos + EVENT.size <= len(buf):
+                _, mask, _, length = EVENT.unpack_from(buf, pos)
+                pos += EVENT.size
+                name = buf[pos:pos + length].rstrip(b'\0').decode(sys.getfilesystemencoding(), 'replace')
+                pos += length
+                yield mask, name
+
+    def changed(self):
+        if self.polling:
+            return StatWatcher.changed(self)
+        touched = False
+        for mask, name in self._events():
+            if mask & IN_IGNORED:
+                # the folder itself is gone, nothing can be watched any more
+                _logger.debug('watch of %s removed, fall back to polling', self.path)
+                self.polling = True
+                touched = True
+            elif mask & IN_Q_OVERFLOW or name == self.name:
+                touched = True
+        # events don't always mean a modification, e.g. saving same content
+        return touched and StatWatcher.changed(self)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watch(path):
+    """
+    returns a watcher of path, the best one for current system
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path)
+        except (OSError, AttributeError):
+            _logger.debug('inotify unavailable, watch %s by polling', path, exc_info=1)
+    return StatWatcher(path)
@@ -1,79 +1,884 @@
 #!/usr/bin/env python
+import binascii
+import errno
 import gzip
+import hashlib
+import json
+import os
+import re
+import select
+import socket
 import ssl
+import threading
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
 
 from . import log
-from .ntlmauth import HTTPNtlmAuthHandler
 from .py23 import get_moved_attr, import_moved
 
 _logger = log.getChild('webutil')
 
 Request = get_moved_attr('urllib2', 'urllib.request', 'Request')
-urlopen = get_moved_attr('urllib2', 'urllib.request', 'urlopen')
 URLError = get_moved_attr('urllib2', 'urllib.error', 'URLError')
+HTTPError = get_moved_attr('urllib2', 'urllib.error', 'HTTPError')
 urlparse = get_moved_attr('urlparse', 'urllib.parse', 'urlparse')
 parse_qs = get_moved_attr('urlparse', 'urllib.parse', 'parse_qs')
 urlencode = get_moved_attr('urllib', 'urllib.parse', 'urlencode')
 urljoin = get_moved_attr('urlparse', 'urllib.parse', 'urljoin')
 url_request = import_moved('urllib2', 'urllib.request')
+HTTPConnection = get_moved_attr('httplib', 'http.client', 'HTTPConnection')
+HTTPSConnection = get_moved_attr('httplib', 'http.client', 'HTTPSConnection')
+HTTPResponse = get_moved_attr('httplib', 'http.client', 'HTTPResponse')
+HTTPException = get_moved_attr('httplib', 'http.client', 'HTTPException')
+addinfourl = get_moved_attr('urllib', 'urllib.response', 'addinfourl')
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) ' \
+                     'Chrome/29.0.1521.3 Safari/537.36'
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections shared among requests, keyed by scheme, host
+    (the proxy if any) and tunnelled host.
+
+    At most max_idle idle connections are kept for each key. Connections
+    idle for longer than idle_timeout seconds, or closed by the peer, are
+    evicted instead of being reused.
+    """
+
+    def __init__(self, max_idle=4, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._idle = dict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _is_stale(conn):
+        if conn.sock is None:
+            return True
+        try:
+            # an idle connection must have nothing to read, otherwise the
+            # peer has closed it or sent unexpected data
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (ValueError, socket.error):
+            return True
+        return bool(readable)
+
+    def acquire(self, key, factory):
+        """
+        get an idle connection of key or create a new one by factory.
+        returns (connection, reused)
+        """
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if time.time() - last_used > self.idle_timeout or self._is_stale(conn):
+                    self.evictions += 1
+                    conn.close()
+                    continue
+                self.hits += 1
+                return conn, True
+            self.misses += 1
+        return factory(), False
+
+    def release(self, key, conn, reusable=True):
+        if not reusable:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            idle.append((conn, time.time()))
+            while len(idle) > self.max_idle:
+                self.evictions += 1
+                idle.pop(0)[0].close()
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'idle': sum(len(idle) for idle in self._idle.values()),
+            }
+
+
+default_pool = ConnectionPool()
+
+
+class PooledHTTPResponse(HTTPResponse):
+    """
+    response which hands its connection back to the pool once closed
+    """
+    pool_release = None
+
+    def _release(self):
+        release, self.pool_release = self.pool_release, None
+        if release:
+            release(reusable=not self.will_close)
+
+    def close(self):
+        if self.fp and self.length != 0 and self._method != 'HEAD':
+            # the rest of body left in socket makes the connection unusable
+            self.will_close = True
+        HTTPResponse.close(self)
+        # python 2 closes the response once its body is read
+        self._release()
+
+    def _close_conn(self):
+        # python 3 calls this instead of close() once the body is read
+        HTTPResponse._close_conn(self)
+        self._release()
+
+
+class PooledHTTPConnection(HTTPConnection):
+    response_class = PooledHTTPResponse
+
+
+class PooledHTTPSConnection(HTTPSConnection):
+    response_class = PooledHTTPResponse
+
+
+def _host_and_selector(req):
+    # python 3.4 removed the getters of python 2
+    if hasattr(req, 'get_host'):
+        return req.get_host(), req.get_selector()
+    return req.host, req.selector
+
+
+class _PooledHandlerMixin:
+    def _pool_acquire(self, http_class, req, tunnel_headers, **http_conn_args):
+        host, _ = _host_and_selector(req)
+        if not host:
+            raise URLError('no host given')
+
+        def create():
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+            conn.set_debuglevel(self._debuglevel)
+            if req._tunnel_host:
+                conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            return conn
+
+        key = (http_class.__name__, host, req._tunnel_host)
+        conn, reused = self.pool.acquire(key, create)
+        return key, conn, reused
+
+    def _pool_attach(self, key, conn, r):
+        # the connection goes back to pool once the response is done
+        if r.will_close:
+            conn.close()
+        else:
+            r.pool_release = partial(self.pool.release, key, conn)
+
+    def _pooled_open(self, http_class, req, **http_conn_args):
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_headers = dict()
+        if req._tunnel_host and 'Proxy-Authorization' in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        host, selector = _host_and_selector(req)
+        while True:
+            key, conn, reused = self._pool_acquire(http_class, req, tunnel_headers, **http_conn_args)
+            try:
+                conn.request(req.get_method(), selector, req.data, headers)
+                r = conn.getresponse()
+            except (socket.error, HTTPException) as err:
+                conn.close()
+                if reused:
+                    _logger.debug('pooled connection to %s is broken, retry with a new one', host)
+                    continue
+                raise URLError(err)
+            break
+
+        _logger.debug('%s connection to %s, pool stats %s',
+                      'reuse' if reused else 'new', host, self.pool.stats())
+        self._pool_attach(key, conn, r)
+        if not hasattr(r, 'getcode'):
+            # python 2 response is wrapped the same way as urllib2 does
+            r.recv = r.read
+            resp = addinfourl(socket._fileobject(r, close=True), r.msg, req.get_full_url())
+            resp.code = r.status
+            resp.msg = r.reason
+            return resp
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+
+class PooledHTTPHandler(_PooledHandlerMixin, url_request.HTTPHandler):
+    def __init__(self, debuglevel=0, pool=None):
+        url_request.HTTPHandler.__init__(self, debuglevel)
+        self.pool = pool or default_pool
+
+    def http_open(self, req):
+        return self._pooled_open(PooledHTTPConnection, req)
+
+    def connect(self, req):
+        """
+        returns a pooled connection for req and a callable giving it back
+        once a response is done, for handlers sending requests on their own
+        """
+        key, conn, _ = self._pool_acquire(PooledHTTPConnection, req, dict())
+        return conn, partial(self._pool_attach, key, conn)
+
+
+class PooledHTTPSHandler(_PooledHandlerMixin, url_request.HTTPSHandler):
+    def __init__(self, debuglevel=0, context=None, pool=None):
+        url_request.HTTPSHandler.__init__(self, debuglevel, context)
+        self.pool = pool or default_pool
+
+    def https_open(self, req):
+        return self._pooled_open(PooledHTTPSConnection, req, context=self._context)
+
+
+_opener = None
+
+
+def build_opener(*handlers):
+    return url_request.build_opener(
+        PooledHTTPHandler(),
+        PooledHTTPSHandler(context=ssl.create_default_context()),
+        *handlers
+    )
+
+
+_engine = None
+
+
+def set_engine(name):
+    """
+    select how requests are sent: 'urllib' (default) or 'asyncio', which
+    shares one event loop among all requests. returns name of the engine
+    actually in use
+    """
+    global _engine
+    if name != 'asyncio':
+        _engine = None
+        return 'urllib'
+    try:
+        from . import aioweb
+    except (ImportError, SyntaxError):
+        _logger.warning('asyncio engine is not supported by this python, use urllib instead')
+        _engine = None
+        return 'urllib'
+    _engine = aioweb.default_engine()
+    return name
+
+
+def urlopen(req):
+    global _opener
+    if _engine is not None:
+        return _engine.urlopen(req)
+    if _opener is None:
+        _opener = build_opener()
+    return _opener.open(req)
 
 
 def setup_proxy(proxy_protocols, proxy_url, proxy_port, sites, username="", password=""):
+    global _opener
     proxy_dict = {p: '%s:%s' % (proxy_url, proxy_port) for p in proxy_protocols}
     ph = url_request.ProxyHandler(proxy_dict)
     passman = url_request.HTTPPasswordMgrWithDefaultRealm()
 
     _logger.info('add proxy site %s', sites)
     passman.add_password(None, sites, username, password)
-    pnah = HTTPNtlmAuthHandler.ProxyNtlmAuthHandler(passman)
+    http_handler = PooledHTTPHandler(debuglevel=99)
+    # ntlm and its des tables are loaded only when a proxy is used. ntlm
+    # authenticates a connection, so the handshake is made on a pooled one
+    # to serve later requests as well
+    from .ntlmauth import HTTPNtlmAuthHandler
+    pnah = HTTPNtlmAuthHandler.ProxyNtlmAuthHandler(passman, connect=http_handler.connect)
     pbah = url_request.ProxyBasicAuthHandler(passman)
     pdah = url_request.ProxyDigestAuthHandler(passman)
 
     cp = url_request.HTTPCookieProcessor()
     context = ssl.create_default_context()
     opener = url_request.build_opener(cp,
-                                      url_request.HTTPSHandler(debuglevel=1, context=context),
-                                      url_request.HTTPHandler(debuglevel=99),
+                                      PooledHTTPSHandler(debuglevel=1, context=context),
+                                      http_handler,
                                       ph, pnah, pbah, pdah,
                                       url_request.HTTPErrorProcessor())
     url_request.install_opener(opener)
+    _opener = opener
+
+
+def remove_proxy():
+    global _opener
+    url_request.install_opener(None)
+    _opener = None
+
+
+GZIP_MAGIC = b'\x1f\x8b\x08\x00\x00\x00'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 def _ungzip(html):
-    if html[:6] == b'\x1f\x8b\x08\x00\x00\x00':
+    if html[:6] == GZIP_MAGIC:
         html = gzip.GzipFile(fileobj=BytesIO(html)).read()
     return html
 
 
-def loadurl(url, headers=None, optional=False):
-    headers = headers or dict()
-    if not url:
-        return None
+def _open(url, headers, optional):
     _logger.debug('getting url %s, headers %s', url, headers)
     if 'User-Agent' not in headers:
-        headers[
-            'User-Agent'
-        ] = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/29.0.1521.3 Safari/537.36'
+        headers['User-Agent'] = DEFAULT_USER_AGENT
     try:
         req = Request(url=url, headers=headers)
-        con = urlopen(req)
+        return urlopen(req)
     except Exception as err:
         if not optional:
             _logger.error('error %s occurs during load %s with header %s', err, url, headers)
         _logger.debug('', exc_info=1)
         return None
+
+
+def loadurl(url, headers=None, optional=False):
+    headers = headers or dict()
+    if not url:
+        return None
+    con = _open(url, headers, optional)
     if con:
         _logger.debug("Hit %s code: %s", str(con), con.getcode())
         data = con.read()
         data = _ungzip(data)
-        _logger.log(log.PAGEDUMP, repr(data))
+        log.dump_payload(_logger, data, url)
         return data
-    else:
-        _logger.error("No data returned.")
     return None
 
 
+def _replace_file(src, dst):
+    replace = getattr(os, 'replace', None)
+    if replace:
+        replace(src, dst)
+        return
+    # python 2 can't rename over an existing file on Windows
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def _create_temp(outfile):
+    # unlike tempfile.mkstemp, the file is created with permissions decided
+    # by umask, same as what open() creates
+    folder, filename = os.path.split(os.path.abspath(outfile))
+    while True:
+        tmpfile = os.path.join(folder, '.{}.{}.tmp'.format(filename, binascii.hexlify(os.urandom(4)).decode()))
+        try:
+            return tmpfile, os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+
+def _stream_to(con, outf, chunk_size, digest=None):
+    size = 0
+    received = 0
+    decompressor = None
+    first = True
+    while True:
+        chunk = con.read(chunk_size)
+        if not chunk:
+            break
+        received += len(chunk)
+        if first:
+            first = False
+            # same detection rule as _ungzip, decided by the head of the body
+            if chunk[:6] == GZIP_MAGIC:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor:
+            chunk = decompressor.decompress(chunk)
+        outf.write(chunk)
+        if digest:
+            digest.update(chunk)
+        size += len(chunk)
+    # python 3 http.client returns a short read instead of raising
+    # IncompleteRead when the peer drops connection in the middle
+    length = con.headers.get('Content-Length', None)
+    if length and received < int(length):
+        raise IOError('connection closed at byte {} of {}'.format(received, length))
+    if decompressor:
+        if not getattr(decompressor, 'eof', True):
+            raise IOError('gzipped content is truncated')
+        chunk = decompressor.flush()
+        outf.write(chunk)
+        if digest:
+            digest.update(chunk)
+        size += len(chunk)
+    return size
+
+
+def download(url, outfile, headers=None, optional=False, chunk_size=DOWNLOAD_CHUNK_SIZE, digest=None):
+    """
+    Stream the content of url into outfile chunk by chunk.
+
+    Data are written into a temporary file in the same folder which replaces
+    outfile atomically once the download completes, so a broken transfer
+    never leaves a truncated outfile behind. gzipped content is decoded on
+    the fly. If digest (a hashlib object) is given it's updated with saved
+    content. Returns number of bytes saved, or None on failure.
+    """
+    headers = headers or dict()
+    if not url:
+        return None
+    con = _open(url, headers, optional)
+    if not con:
+        return None
+    _logger.debug("Hit %s code: %s", str(con), con.getcode())
+    tmpfile, fd = _create_temp(outfile)
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            size = _stream_to(con, outf, chunk_size, digest)
+        if not size:
+            _logger.error("No data returned.")
+            os.remove(tmpfile)
+            return None
+        _replace_file(tmpfile, outfile)
+    except Exception as err:
+        if not optional:
+            _logger.error('error %s occurs during download %s to %s', err, url, outfile)
+        _logger.debug('', exc_info=1)
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return None
+    finally:
+        con.close()
+    _logger.debug('%d bytes of %s saved to %s', size, url, outfile)
+    return size
+
+
+def _file_digest(filename, digest, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+
+
+class _RangeIgnored(Exception):
+    pass
+
+
+class ResumableDownload:
+    """
+    Download a large file which survives broken transfers.
+
+    Data are written into `outfile.part` and the progress is kept in a
+    sidecar `outfile.part.json` together with the validator (ETag or
+    Last-Modified) and size of the remote file. Next download of the same
+    url resumes from where it stopped with ranged GETs guarded by If-Range,
+    so a remote file changed in between is downloaded from scratch.
+
+    With `segments` > 1 a file of at least `segments` * MIN_SEGMENT_SIZE
+    bytes is split into byte ranges downloaded in parallel.
+    """
+    MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+    # how often progress is written into the sidecar
+    SAVE_INTERVAL = 1024 * 1024
+
+    def __init__(self, url, outfile, headers=None, optional=False,
+                 chunk_size=DOWNLOAD_CHUNK_SIZE, segments=1):
+        self.url = url
+        self.outfile = outfile
+        self.partfile = outfile + '.part'
+        self.statefile = self.partfile + '.json'
+        self.headers = dict(headers or dict())
+        self.headers.setdefault('User-Agent', DEFAULT_USER_AGENT)
+        # ranges apply to encoded content, never ask for compression
+        self.headers['Accept-Encoding'] = 'identity'
+        self.optional = optional
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.state = None
+        self._lock = threading.Lock()
+
+    def _load_state(self):
+        try:
+            with open(self.statefile, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if state.get('url', None) != self.url or not os.path.isfile(self.partfile):
+            return None
+        return state
+
+    def _save_state(self):
+        if not self.state['validator']:
+            # nothing guards the resumed data, never resume it
+            return
+        with self._lock:
+            tmpfile = self.statefile + '.tmp'
+            with open(tmpfile, 'w') as f:
+                json.dump(self.state, f)
+            _replace_file(tmpfile, self.statefile)
+
+    def _clear(self):
+        for f in (self.partfile, self.statefile):
+            if os.path.exists(f):
+                os.remove(f)
+
+    @staticmethod
+    def _validator(etag, last_modified):
+        # If-Range accepts strong ETag only
+        if etag and not etag.startswith('W/'):
+            return etag
+        return last_modified
+
+    def _new_state(self, length, validator, segments):
+        if length and segments > 1:
+            size = -(-length // segments)
+            ranges = [[start, min(start + size, length)] for start in range(0, length, size)]
+        else:
+            ranges = [[0, length]]
+        self.state = {'url': self.url, 'length': length, 'validator': validator, 'segments': ranges}
+        with open(self.partfile, 'wb') as f:
+            if length and segments > 1:
+                f.truncate(length)
+        self._save_state()
+
+    def _request(self, start, end):
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes={}-{}'.format(start, '' if end is None else end - 1)
+        headers['If-Range'] = self.state['validator']
+        con = urlopen(Request(url=self.url, headers=headers))
+        match = _CONTENT_RANGE.match(con.headers.get('Content-Range', ''))
+        if con.getcode() != 206 or not match or int(match.group(1)) != start:
+            raise _RangeIgnored(con)
+        return con
+
+    def _fetch(self, segment, con=None):
+        con = con or self._request(*segment)
+        unsaved = 0
+        try:
+            with open(self.partfile, 'r+b') as f:
+                f.seek(segment[0])
+                while segment[1] is None or segment[0] < segment[1]:
+                    want = self.chunk_size if segment[1] is None else min(self.chunk_size, segment[1] - segment[0])
+                    chunk = con.read(want)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    f.flush()
+                    with self._lock:
+                        segment[0] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= self.SAVE_INTERVAL:
+                        self._save_state()
+                        unsaved = 0
+        finally:
+            con.close()
+            self._save_state()
+        if segment[1] is None:
+            segment[1] = segment[0]
+        elif segment[0] < segment[1]:
+            raise IOError('connection closed at byte {} of {}'.format(segment[0], segment[1]))
+
+    def _start(self):
+        length, validator = None, None
+        if self.segments > 1:
+            info = probe(self.url, self.headers)
+            if info and info.exists and info.accept_ranges and info.content_length \
+                    and info.content_length >= self.segments * self.MIN_SEGMENT_SIZE:
+                length, validator = info.content_length, self._validator(info.etag, info.last_modified)
+        if length and validator:
+            _logger.debug('download %s in %d segments', self.url, self.segments)
+            self._new_state(length, validator, self.segments)
+            return self._fetch_all()
+        self._restart(urlopen(Request(url=self.url, headers=self.headers)))
+
+    def _restart(self, con):
+        length = None
+        if not con.headers.get('Content-Encoding', None) and con.headers.get('Content-Length', None):
+            length = int(con.headers.get('Content-Length'))
+        self._new_state(length, self._validator(con.headers.get('ETag', None), con.headers.get('Last-Modified', None)), 1)
+        self._fetch(self.state['segments'][0], con)
+
+    def _fetch_all(self):
+        pending = [seg for seg in self.state['segments'] if seg[1] is None or seg[0] < seg[1]]
+        if len(pending) == 1:
+            return self._fetch(pending[0])
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = [executor.submit(self._fetch, seg) for seg in pending]
+        errors = [future.exception() for future in futures if future.exception()]
+        # responses of ignored ranges are useless, whoever catches the
+        # raised error never sees those of other segments
+        for err in errors:
+            if isinstance(err, _RangeIgnored):
+                err.args[0].close()
+        if errors:
+            raise errors[0]
+
+    def run(self, digest=None):
+        """
+        returns number of bytes saved, or None on failure. the sidecar is
+        kept for next run if the transfer broke
+        """
+        try:
+            self.state = self._load_state()
+            if not self.state:
+                self._start()
+            else:
+                _logger.info('resume downloading %s from %s', self.url,
+                             ', '.join(str(seg[0]) for seg in self.state['segments']))
+                self._resume()
+            size = os.path.getsize(self.partfile)
+            if not size or (self.state['length'] and size != self.state['length']):
+                raise IOError('{} bytes received, {} expected'.format(size, self.state['length']))
+            if digest:
+                _file_digest(self.partfile, digest)
+            _replace_file(self.partfile, self.outfile)
+            self._clear()
+        except Exception as err:
+            if not self.optional:
+                _logger.error('error %s occurs during download %s to %s', err, self.url, self.outfile)
+            _logger.debug('', exc_info=1)
+            if not self.state or not self.state['validator']:
+                self._clear()
+            return None
+        _logger.debug('%d bytes of %s saved to %s', size, self.url, self.outfile)
+        return size
+
+    def _resume(self):
+        try:
+            self._fetch_all()
+        except _RangeIgnored as ignored:
+            _logger.info('%s is changed or not resumable, download it again', self.url)
+            con = ignored.args[0]
+            if len(self.state['segments']) == 1 and con.getcode() == 200:
+                self._restart(con)
+            else:
+                con.close()
+                self._start()
+        except HTTPError as err:
+            if err.code != 416:
+                raise
+            err.close()
+            _logger.info('range of %s is not satisfiable, download it again', self.url)
+            self._start()
+
+
+def download_resumable(url, outfile, headers=None, optional=False, digest=None, segments=1):
+    """
+    Same as `download`, but a broken transfer is resumed by the next call
+    with same url and outfile. See ResumableDownload.
+    """
+    if not url:
+        return None
+    return ResumableDownload(url, outfile, headers, optional, segments=segments).run(digest)
+
+
+class HttpCache:
+    """
+    On-disk cache of small responses such as the archive json.
+
+    Every entry keeps the body together with its validators (ETag and
+    Last-Modified) and expiry computed from Cache-Control max-age. Least
+    recently used entries are evicted once there are more than max_entries
+    entries or max_bytes bytes of bodies.
+    """
+
+    def __init__(self, folder, max_entries=32, max_bytes=1024 * 1024):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, url, ext):
+        key = hashlib.sha1(url.encode('utf8')).hexdigest()
+        return os.path.join(self.folder, key + ext)
+
+    def lookup(self, url):
+        """
+        returns (entry, body) of url or (None, None) if not cached
+        """
+        try:
+            with open(self._path(url, '.json'), 'r') as f:
+                entry = json.load(f)
+            with open(self._path(url, '.body'), 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None, None
+        if entry.get('url', None) != url or entry.get('size', None) != len(body):
+            return None, None
+        # touch the entry so that it's considered as recently used
+        os.utime(self._path(url, '.json'), None)
+        return entry, body
+
+    @staticmethod
+    def _expires(headers):
+        cache_control = [
+            d.strip().lower() for d in headers.get('Cache-Control', '').split(',')
+        ]
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            return 0
+        for directive in cache_control:
+            if directive.startswith('max-age='):
+                try:
+                    return time.time() + int(directive[len('max-age='):])
+                except ValueError:
+                    break
+        return 0
+
+    @staticmethod
+    def _write_file(path, data):
+        # a crash in the middle never leaves a torn file, readers see either
+        # the old or the new content
+        tmpfile, fd = _create_temp(path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            _replace_file(tmpfile, path)
+        except Exception:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def _write(self, url, entry, body=None):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        if body is not None:
+            self._write_file(self._path(url, '.body'), body)
+        self._write_file(self._path(url, '.json'), json.dumps(entry).encode('utf8'))
+
+    def store(self, url, headers, body):
+        if 'no-store' in headers.get('Cache-Control', '').lower():
+            return
+        entry = {
+            'url': url,
+            'etag': headers.get('ETag', None),
+            'last_modified': headers.get('Last-Modified', None),
+            'expires': self._expires(headers),
+            'size': len(body),
+        }
+        with self._lock:
+            self._write(url, entry, body)
+            self.evict()
+
+    def refresh(self, url, entry, headers):
+        # a 304 response may update validators and expiry
+        entry['etag'] = headers.get('ETag', None) or entry['etag']
+        entry['last_modified'] = headers.get('Last-Modified', None) or entry['last_modified']
+        entry['expires'] = self._expires(headers)
+        with self._lock:
+            self._write(url, entry)
+
+    def note(self, url):
+        """
+        returns the note annotated to cached url, or None
+        """
+        entry, _ = self.lookup(url)
+        return entry.get('note', None) if entry else None
+
+    def annotate(self, url, note):
+        """
+        keep a json serializable note with cached url, e.g. what has been
+        done with its content. the note is dropped once content changes
+        """
+        with self._lock:
+            entry, _ = self.lookup(url)
+            if entry is None:
+                return
+            entry['note'] = note
+            self._write(url, entry)
+
+    def invalidate(self, url):
+        with self._lock:
+            for ext in ('.json', '.body'):
+                if os.path.exists(self._path(url, ext)):
+                    os.remove(self._path(url, ext))
+
+    def evict(self):
+        try:
+            names = [n for n in os.listdir(self.folder) if n.endswith('.json')]
+        except OSError:
+            return
+        entries = list()
+        for name in names:
+            meta = os.path.join(self.folder, name)
+            body = meta[:-len('.json')] + '.body'
+            try:
+                entries.append((os.path.getmtime(meta), meta, body, os.path.getsize(body)))
+            except OSError:
+                entries.append((0, meta, body, 0))
+        entries.sort(reverse=True)
+        total = 0
+        for i, (_, meta, body, size) in enumerate(entries):
+            total += size
+            if i < self.max_entries and total <= self.max_bytes:
+                continue
+            _logger.debug('evict cached %s', meta)
+            for path in (meta, body):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def load_cached(url, cache, headers=None, optional=False):
+    """
+    load url through cache with conditional GET.
+
+    returns (data, not_modified). not_modified is True if the cached data is
+    still fresh or the server responds 304, in which case data is the cached
+    body. (None, False) is returned on failure.
+    """
+    headers = dict(headers or dict())
+    entry, body = cache.lookup(url)
+    if entry is not None:
+        if entry['expires'] > time.time():
+            _logger.debug('cached %s is still fresh', url)
+            return body, True
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    if 'User-Agent' not in headers:
+        headers['User-Agent'] = DEFAULT_USER_AGENT
+    _logger.debug('getting url %s through cache, headers %s', url, headers)
+    try:
+        con = urlopen(Request(url=url, headers=headers))
+        data = _ungzip(con.read())
+    except HTTPError as err:
+        err.close()
+        if err.code == 304 and entry is not None:
+            _logger.debug('%s is not modified', url)
+            cache.refresh(url, entry, err.headers)
+            return body, True
+        if not optional:
+            _logger.error('error %s occurs during load %s with header %s', err, url, headers)
+        return None, False
+    except Exception as err:
+        if not optional:
+            _logger.error('error %s occurs during load %s with header %s', err, url, headers)
+        _logger.debug('', exc_info=1)
+        return None, False
+    log.dump_payload(_logger, data, url)
+    try:
+        cache.store(url, con.headers, data)
+    except (IOError, OSError):
+        _logger.warning('can not save %s into cache', url, exc_info=1)
+    return data, False
+
+
 def loadpage(url, codec=('utf8', 'strict'), headers=None, optional=False):
     headers = headers or dict()
     data = loadurl(url, headers=headers, optional=optional)
@@ -102,11 +907,132 @@ def postto(url, datadict, headers=None, decodec='gbk'):
         _logger.debug('', exc_info=1)
 
 
-def test_header(url, extra_headers=None):
-    headers = {
-        'method': 'HEAD',
-    }
+class MethodRequest(Request):
+    """
+    Request with an explicit HTTP method, works with both python 2 and 3
+    """
+
+    def __init__(self, url, method, headers=None):
+        Request.__init__(self, url=url, headers=headers or dict())
+        self._probe_method = method
+
+    def get_method(self):
+        return self._probe_method
+
+
+class ProbeResult(namedtuple('ProbeResult', [
+    'url', 'status', 'content_length', 'etag', 'last_modified', 'accept_ranges'
+])):
+    @property
+    def exists(self):
+        return 200 <= self.status < 300
+
+
+_CONTENT_RANGE_TOTAL = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+
+
+def _probe_result(url, status, headers):
+    content_length = None
+    content_range = headers.get('Content-Range', None)
+    match = _CONTENT_RANGE_TOTAL.match(content_range) if content_range else None
+    if match:
+        content_length = int(match.group(1))
+    elif status != 206 and headers.get('Content-Length', None):
+        content_length = int(headers.get('Content-Length'))
+    return ProbeResult(
+        url, status, content_length,
+        headers.get('ETag', None),
+        headers.get('Last-Modified', None),
+        headers.get('Accept-Ranges', '').lower() == 'bytes' or match is not None,
+    )
+
+
+def _probe_once(url, method, headers):
+    try:
+        con = urlopen(MethodRequest(url, method, headers))
+    except HTTPError as err:
+        err.close()
+        return _probe_result(url, err.code, err.headers)
+    try:
+        return _probe_result(url, con.getcode(), con.headers)
+    finally:
+        # never read the body, the connection is simply dropped
+        con.close()
+
+
+def probe(url, extra_headers=None):
+    """
+    Detect existence and metadata of a resource without downloading its body.
+
+    A HEAD request is sent at first. If the server refuses HEAD a ranged GET
+    of the first byte is sent instead and the response is closed unread.
+    Returns a ProbeResult or None if the server can't be reached at all.
+    """
+    headers = {'User-Agent': DEFAULT_USER_AGENT}
     if extra_headers:
         headers.update(extra_headers)
-    resp = loadurl(url, headers, True)
-    return resp is not None
+    _logger.debug('probing url %s, headers %s', url, headers)
+    try:
+        result = _probe_once(url, 'HEAD', headers)
+        if result.status in (405, 501):
+            _logger.debug('HEAD is refused by %s, try ranged GET', url)
+            headers['Range'] = 'bytes=0-0'
+            result = _probe_once(url, 'GET', headers)
+    except Exception as err:
+        _logger.debug('error %s occurs during probing %s', err, url, exc_info=1)
+        return None
+    _logger.debug('probed %s', result)
+    return result
+
+
+def test_header(url, extra_headers=None):
+    result = probe(url, extra_headers)
+    return result is not None and result.exists
+
+
+def _timed_probe(probe, url):
+    begin = time.time()
+    try:
+        exists = probe(url)
+    except Exception:
+        _logger.debug('error occurs when probing %s', url, exc_info=1)
+        exists = False
+    return exists, time.time() - begin
+
+
+def probe_candidates(urls, probe=None, max_workers=None):
+    """
+    Probe all candidate urls concurrently and pick the first existing one
+    in the given (priority) order.
+
+    The winner is returned as soon as it and every candidate ahead of it
+    have answered. Probes of lower priority candidates which haven't
+    started are dropped; those already running are not waited for but
+    left to finish in background, each costs no more than a body-less
+    response.
+
+    Returns a tuple (url, timings) where url is None if no candidate exists
+    and timings maps each answered url to its probing time in seconds.
+    """
+    probe = probe or test_header
+    urls = list(urls)
+    timings = dict()
+    if not urls:
+        return None, timings
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(urls))
+    futures = [executor.submit(_timed_probe, probe, url) for url in urls]
+    winner = None
+    try:
+        for url, future in zip(urls, futures):
+            exists, elapsed = future.result()
+            timings[url] = elapsed
+            _logger.debug('probed %s in %.3f seconds, exists=%s', url, elapsed, exists)
+            if exists:
+                winner = url
+                break
+    finally:
+        # running probes can't be interrupted, only pending ones are dropped
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return winner, timings
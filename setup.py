@@ -20,7 +20,7 @@ def os_requires():
     return ['Pillow', 'pypiwin32'] if sys.platform == 'win32' else []
 
 def backport_requires():
-    return ['configparser', 'subprocess32'] if sys.version_info[0] == 2 else []
+    return ['configparser', 'futures', 'subprocess32'] if sys.version_info[0] == 2 else []
 
 def requires():
     return os_requires() + backport_requires()
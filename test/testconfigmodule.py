@@ -98,6 +98,35 @@ class TestConfigureDatabase(unittest.TestCase):
             db.add_param(new_param)
         self.assertListEqual(db.parameters, params)
 
+    def test_add_param_group(self):
+        params = [ConfigParameter('123'), ConfigParameter('456')]
+        db = ConfigDatabase('test1', description='test desc', parameters=params)
+        group = [ConfigParameter('789'), ConfigParameter('abc')]
+        db.add_params(group)
+        self.assertListEqual(db.parameters, params+group)
+        self.assertIs(db.get_param('abc'), group[1])
+        self.assertIsNone(db.get_param('def'))
+
+    def test_no_dup_param_group(self):
+        params = [ConfigParameter('123'), ConfigParameter('456')]
+        db = ConfigDatabase('test1', description='test desc', parameters=params)
+        with self.assertRaises(NameError):
+            db.add_params([ConfigParameter('789'), ConfigParameter('456')])
+        with self.assertRaises(NameError):
+            db.add_params([ConfigParameter('789'), ConfigParameter('789')])
+        self.assertListEqual(db.parameters, params)
+        self.assertIsNone(db.get_param('789'))
+
+    def test_params_by_option(self):
+        db = getdb()
+        p1 = ConfigParameter('p1', loader_opts={'conffile': {'key': 'k1'}})
+        db.add_param(p1)
+        self.assertListEqual(db.get_params_by_option('conffile', 'key', 'k1'), [p1])
+        p2 = ConfigParameter('p2', loader_opts={'conffile': {'key': 'k1'}})
+        db.add_param(p2)
+        self.assertListEqual(db.get_params_by_option('conffile', 'key', 'k1'), [p1, p2])
+        self.assertListEqual(db.get_params_by_option('conffile', 'key', 'k2'), [])
+
 
 class TestCliLoader(unittest.TestCase):
     def getdb(self):
@@ -437,6 +466,56 @@ class TestConfigFileDumper(unittest.TestCase):
             self.assertEqual(getattr(ans, k), v)
         self.assertEqual(ans, self.conf)
 
+class TestLayeredConfig(unittest.TestCase):
+    def setUp(self):
+        self.db = getdb()
+        self.db.add_params([
+            ConfigParameter(name='clip', defaults='cli-def', loader_opts={'conffile': {'section': 's'}}),
+            ConfigParameter(name='filep', defaults='file-def', loader_opts={'conffile': {'section': 's'}}),
+            ConfigParameter(name='listp', defaults=[], loader_opts={'conffile': {
+                'section': 's', 'converter': lambda arg: arg.split(','),
+            }}),
+        ])
+        self.resolver = config.LayeredConfig(self.db, ['--clip', 'cli-val'])
+
+    def load_file(self, content):
+        self.resolver.set_layer('file', ConfigFileLoader().load(self.db, StringIO(content)))
+
+    def test_precedence(self):
+        self.load_file('[s]\nclip = file-val\nfilep = file-val\n')
+        ans = self.resolver.resolve()
+        self.assertEqual(ans.clip, 'cli-val')
+        self.assertEqual(ans.filep, 'file-val')
+        self.assertEqual(ans.listp, [])
+        self.assertDictEqual(self.resolver.sources, {'clip': 'cli', 'filep': 'file', 'listp': 'default'})
+
+    def test_reload_file(self):
+        self.load_file('[s]\nfilep = v1\n')
+        self.assertEqual(self.resolver.resolve().filep, 'v1')
+        cli = self.resolver.layers['cli']
+        self.load_file('[s]\nlistp = a,b\n')
+        ans = self.resolver.resolve()
+        self.assertEqual(ans.filep, 'file-def')
+        self.assertEqual(ans.listp, ['a', 'b'])
+        self.assertIs(self.resolver.layers['cli'], cli)
+        self.resolver.set_layer('file', None)
+        self.assertEqual(self.resolver.sources['listp'], 'file')
+        self.assertEqual(self.resolver.resolve().listp, [])
+        self.assertEqual(self.resolver.sources['listp'], 'default')
+
+    def test_values_copied(self):
+        ans = self.resolver.resolve()
+        ans.listp.append('changed')
+        self.assertEqual(self.resolver.resolve().listp, [])
+
+    def test_lazy_pretty(self):
+        ans = self.resolver.resolve()
+        self.assertEqual(
+            str(config.LazyPretty(ans, ';', self.resolver.sources)),
+            "clip = 'cli-val'  (cli);filep = 'file-def'  (default);listp = []  (default)"
+        )
+
+
 class TestOtherUtil(unittest.TestCase):
     def test_merge(self):
         ns1 = Namespace()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import log
+
+
+class CountedPayload:
+    def __init__(self):
+        self.repr_count = 0
+
+    def __repr__(self):
+        self.repr_count += 1
+        return 'x' * 100
+
+
+class TestDumpPayload(unittest.TestCase):
+    def setUp(self):
+        self.logger = log.getChild('testlog')
+        self.folder = tempfile.mkdtemp()
+        log.setDumpFolder(self.folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        self.logger.setLevel(log.INFO)
+
+    def test_no_cost_when_disabled(self):
+        self.logger.setLevel(log.INFO)
+        payload = CountedPayload()
+        log.dump_payload(self.logger, payload)
+        self.assertEqual(payload.repr_count, 0)
+        self.assertListEqual(os.listdir(self.folder), [])
+
+    def test_small_payload_in_log(self):
+        self.logger.setLevel(log.PAGEDUMP)
+        payload = CountedPayload()
+        with self.assertLogs(self.logger, log.PAGEDUMP) as cm:
+            log.dump_payload(self.logger, payload)
+        self.assertEqual(payload.repr_count, 1)
+        self.assertIn('x' * 100, cm.output[0])
+        self.assertListEqual(os.listdir(self.folder), [])
+
+    def test_large_payload_to_side_file(self):
+        self.logger.setLevel(log.PAGEDUMP)
+        payload = b'0123456789' * 100
+        with self.assertLogs(self.logger, log.PAGEDUMP) as cm:
+            log.dump_payload(self.logger, payload, limit=10)
+        self.assertIn('truncated', cm.output[0])
+        self.assertNotIn('0123456789' * 2, cm.output[0])
+        dumped = os.listdir(self.folder)
+        self.assertEqual(len(dumped), 1)
+        with open(os.path.join(self.folder, dumped[0]), 'rb') as inf:
+            self.assertEqual(inf.read(), payload)
+
+    def test_no_side_file_at_debug(self):
+        self.logger.setLevel(log.DEBUG)
+        payload = b'0123456789' * 100
+        with self.assertLogs(self.logger, log.DEBUG) as cm:
+            log.dump_payload(self.logger, payload, level=log.DEBUG, limit=10)
+        self.assertIn('truncated', cm.output[0])
+        self.assertNotIn('0123456789' * 2, cm.output[0])
+        self.assertListEqual(os.listdir(self.folder), [])
+
+    def test_side_files_rotated(self):
+        self.logger.setLevel(log.PAGEDUMP)
+        limit = log.DUMP_FILES_LIMIT
+        log.DUMP_FILES_LIMIT = 3
+        try:
+            with self.assertLogs(self.logger, log.PAGEDUMP):
+                for i in range(5):
+                    log.dump_payload(self.logger, str(i) * 100, limit=10)
+        finally:
+            log.DUMP_FILES_LIMIT = limit
+        contents = list()
+        for name in os.listdir(self.folder):
+            with open(os.path.join(self.folder, name)) as inf:
+                contents.append(inf.read())
+        self.assertListEqual(sorted(contents), [str(i) * 100 for i in (2, 3, 4)])
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import main
+from pybingwallpaper import record
+from pybingwallpaper import scheduler
+from pybingwallpaper import webutil
+
+
+def fake_metadata(market, day, hsh=None):
+    start = datetime(2019, 5, 16, 7, 0) - timedelta(days=day)
+    return {
+        'copyright': 'photo of {} days ago'.format(day),
+        'copyrightlink': '',
+        'hsh': hsh or '{}-{}'.format(market, day),
+        'urlbase': '/az/hprichbg/rb/{}_{}'.format(market, day),
+        'market': market,
+        'startdate': start.date(),
+        'enddate': (start + timedelta(days=1)).date(),
+        'fullstartdate': start,
+    }
+
+
+class FakePage:
+    """
+    archive of photos from idx to idx + n days ago, every market has its
+    own photo of a day unless a shared hash is given
+    """
+    def __init__(self, market, idx, n, shared=None):
+        self.url = 'http://fake/archive?idx={}&n={}&mkt={}'.format(idx, n, market)
+        self.market_code = market
+        self.not_modified = False
+        self.cache = None
+        self.links = list()
+        for day in range(idx, idx + n):
+            metadata = fake_metadata(market, day, (shared or dict()).get(day, None))
+            link = 'http://fake{}_1920x1080.jpg'.format(metadata['urlbase'])
+            self.links.append(((link,), metadata))
+        self.last_start = self.links[0][1]['fullstartdate']
+
+    def image_links(self):
+        return self.links
+
+
+class TestBatchDownload(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.loads = list()
+        self.downloads = list()
+        self.failed_markets = set()
+        self.shared = dict()
+        self.bad_luck = False
+        self.lock = threading.Lock()
+        self.origin = main.load_wallpaper_page, main.download_image, scheduler.default_scheduler
+        main.load_wallpaper_page = self.fake_load
+        main.download_image = self.fake_download
+        scheduler.default_scheduler = self.poller = scheduler.PollScheduler(
+            interval=7200,
+            clock=lambda: datetime(2019, 5, 16, 12, 0),
+            rand=lambda a, b: 0,
+        )
+        dict.clear(record.default_manager)
+
+    def tearDown(self):
+        main.load_wallpaper_page, main.download_image, scheduler.default_scheduler = self.origin
+        dict.clear(record.default_manager)
+        record.SqlDatabaseRecordManager.close_all()
+        shutil.rmtree(self.folder)
+
+    def load_config(self, *args):
+        args = [
+            '--config-file', os.path.join(self.folder, 'none.conf'),
+            '--output-folder', self.folder,
+        ] + list(args)
+        return main.load_config(main.prepare_config_db(), args)
+
+    def fake_load(self, run_config, idx, n=1, market=None):
+        with self.lock:
+            self.loads.append((market, idx, n))
+        if market in self.failed_markets:
+            raise main.CannotLoadImagePage(market)
+        return FakePage(market, idx, n, self.shared)
+
+    def fake_download(self, run_config, wplinks, metadata, assets=None):
+        if self.bad_luck:
+            return None
+        outfile = main.get_output_filename(run_config, wplinks[0])
+        with open(outfile, 'wb') as outf:
+            outf.write(metadata['hsh'].encode('utf8'))
+        with self.lock:
+            self.downloads.append(wplinks[0])
+        return [record.DownloadRecord(
+            wplinks[0], outfile, metadata['copyright'],
+            raw=metadata['hsh'].encode('utf8'),
+            market=metadata['market'],
+            start_time=metadata['fullstartdate'],
+            end_time=metadata['enddate'],
+            content_hash=record.sha256(metadata['hsh'].encode('utf8')),
+        )]
+
+    def test_split_by_max_n(self):
+        run_config = self.load_config('--backfill', '20', '--offset', '1')
+        records = main.batch_download_wallpapers(run_config)
+        self.assertListEqual(sorted(self.loads), [('', 1, 8), ('', 9, 8), ('', 17, 4)])
+        self.assertEqual(len(self.downloads), 20)
+        # the newest photo comes first
+        self.assertListEqual(
+            [r['url'] for r in records],
+            [FakePage('', day, 1).links[0][0][0] for day in range(1, 21)]
+        )
+
+    def test_skip_downloaded(self):
+        run_config = self.load_config('--backfill', '3')
+        downloaded = main.batch_download_wallpapers(run_config)
+        for r in downloaded[:2]:
+            record.default_manager.add(r)
+        # file of the 2nd photo is gone, it must be downloaded again
+        os.remove(downloaded[1]['local_file'])
+        del self.downloads[:]
+        records = main.batch_download_wallpapers(run_config)
+        self.assertListEqual(self.downloads, [downloaded[1]['url'], downloaded[2]['url']])
+        self.assertListEqual([r['url'] for r in records], self.downloads)
+
+    def test_partial_failure(self):
+        self.failed_markets.add('de-DE')
+        run_config = self.load_config('--markets', 'en-US,de-DE', '--backfill', '2')
+        records = main.batch_download_wallpapers(run_config)
+        self.assertEqual(len(self.loads), 2)
+        self.assertListEqual([r['market'] for r in records], ['en-US', 'en-US'])
+
+    def test_all_failed(self):
+        self.failed_markets.update(('en-US', 'de-DE'))
+        run_config = self.load_config('--markets', 'en-US,de-DE', '--backfill', '2')
+        with self.assertRaises(main.CannotLoadImagePage):
+            main.batch_download_wallpapers(run_config)
+        self.assertListEqual(self.downloads, [])
+
+    def test_wait_for_next_publish(self):
+        run_config = self.load_config()
+        records = main.download_wallpaper(run_config)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(self.poller.succeeded(), 19 * 3600)
+        record.default_manager.add(records[0])
+        self.poller.last_start.clear()
+        # photo in history is as good as a saved one
+        self.assertIsNone(main.download_wallpaper(run_config))
+        self.assertEqual(self.poller.succeeded(), 19 * 3600)
+
+    def test_photo_not_saved(self):
+        self.bad_luck = True
+        self.assertIsNone(main.download_wallpaper(self.load_config()))
+        # publish time of a photo failed to download is not trusted
+        self.assertIsNone(self.poller.next_publish())
+        self.assertEqual(self.poller.succeeded(), 7200)
+
+    def test_batch_photo_not_saved(self):
+        self.bad_luck = True
+        main.batch_download_wallpapers(self.load_config('--markets', 'en-US,de-DE'))
+        self.assertEqual(self.poller.succeeded(), 7200)
+        self.bad_luck = False
+        main.batch_download_wallpapers(self.load_config('--markets', 'en-US,de-DE'))
+        self.assertEqual(self.poller.succeeded(), 19 * 3600)
+
+    def test_shared_photo(self):
+        self.shared[0] = 'shared-hash'
+        database = os.path.join(self.folder, 'history.db')
+        run_config = self.load_config(
+            '--markets', 'en-US,de-DE,ja-JP', '--backfill', '2', '--database-file', database,
+            '--database-split-images',
+        )
+        records = main.batch_download_wallpapers(run_config)
+        # one photo of today for all markets, and one of yesterday per market
+        self.assertEqual(len(self.downloads), 4)
+        self.assertEqual(len(records), 6)
+        today = [r for r in records if r['content_hash'] == record.sha256(b'shared-hash')]
+        self.assertListEqual(sorted(r['market'] for r in today), ['de-DE', 'en-US', 'ja-JP'])
+        self.assertEqual(len(set(r['local_file'] for r in today)), 1)
+
+        history_file = main.HISTORY_FILE
+        main.HISTORY_FILE = os.path.join(self.folder, 'history.json')
+        try:
+            main.save_history(records, run_config, keepold=True)
+        finally:
+            main.HISTORY_FILE = history_file
+        record.SqlDatabaseRecordManager.close_all()
+        conn = sqlite3.connect(database)
+        try:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM BingWallpaperRecords').fetchone()[0], 6)
+            # the shared photo is stored only once
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM BingWallpaperImages').fetchone()[0], 4)
+        finally:
+            conn.close()
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.page = FakePage('en-US', 0, 1)
+        self.page.cache = webutil.HttpCache(os.path.join(self.folder, 'cache'))
+        self.page.cache.store(self.page.url, dict(), b'{}')
+        self.photo = os.path.join(self.folder, 'wallpaper.jpg')
+        with open(self.photo, 'wb') as outf:
+            outf.write(b'photo')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def load_config(self, *args):
+        args = [
+            '--config-file', os.path.join(self.folder, 'none.conf'),
+            '--output-folder', self.folder,
+        ] + list(args)
+        return main.load_config(main.prepare_config_db(), args)
+
+    def test_processed(self):
+        run_config = self.load_config()
+        self.assertFalse(main.is_processed(run_config, self.page))
+        main.mark_processed(run_config, self.page, [self.photo])
+        self.assertTrue(main.is_processed(self.load_config(), self.page))
+
+    def test_file_removed(self):
+        run_config = self.load_config()
+        main.mark_processed(run_config, self.page, [self.photo])
+        os.remove(self.photo)
+        self.assertFalse(main.is_processed(run_config, self.page))
+
+    def test_settings_changed(self):
+        main.mark_processed(self.load_config(), self.page, [self.photo])
+        self.assertFalse(main.is_processed(self.load_config('--size-mode', 'never'), self.page))
+        self.assertFalse(main.is_processed(self.load_config('--collect', 'video'), self.page))
+        self.assertFalse(main.is_processed(self.load_config('-k'), self.page))
+        run_config = self.load_config()
+        run_config.output_folder = os.path.join(self.folder, 'other')
+        self.assertFalse(main.is_processed(run_config, self.page))
+
+
+class TestDaemonContext(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.folder, 'settings.conf')
+        self.calls = list()
+        self.origin = (
+            main.HISTORY_FILE, main.load_history, main.install_proxy,
+            main.prepare_output_dir, webutil.set_engine,
+        )
+        main.HISTORY_FILE = os.path.join(self.folder, 'history.json')
+        main.load_history = lambda: self.calls.append('history')
+        main.install_proxy = lambda run_config: self.calls.append('proxy')
+        main.prepare_output_dir = lambda d: self.calls.append('output_folder')
+        webutil.set_engine = lambda engine: self.calls.append('engine')
+        self.write_config(output_folder=self.folder)
+        self.context = main.DaemonContext(['--config-file', self.config_file, '-s', 'no'])
+        self.context.select_setter = lambda name: self.calls.append('setter')
+
+    def tearDown(self):
+        (
+            main.HISTORY_FILE, main.load_history, main.install_proxy,
+            main.prepare_output_dir, webutil.set_engine,
+        ) = self.origin
+        if self.context.config_watcher:
+            self.context.config_watcher.close()
+        shutil.rmtree(self.folder)
+
+    def write_config(self, proxy_server='', output_folder=''):
+        with open(self.config_file, 'w') as outf:
+            outf.write('[Download]\noutput_folder = {}\n'.format(output_folder))
+            outf.write('[Proxy]\nproxy_server = {}\n'.format(proxy_server))
+
+    def refresh(self):
+        del self.calls[:]
+        return self.context.refresh()
+
+    def test_set_up_once(self):
+        run_config = self.refresh()
+        self.assertEqual(run_config.output_folder, self.folder)
+        self.assertListEqual(
+            sorted(self.calls),
+            ['engine', 'history', 'output_folder', 'output_folder', 'proxy', 'setter']
+        )
+        self.assertIs(self.refresh(), run_config)
+        self.assertListEqual(self.calls, ['output_folder'])
+        self.assertEqual(self.context.reloads, 0)
+
+    def test_history_changed(self):
+        self.refresh()
+        with open(main.HISTORY_FILE, 'w') as outf:
+            outf.write('\n')
+        self.refresh()
+        self.assertListEqual(self.calls, ['output_folder', 'history'])
+        # history written by the daemon itself is not loaded again
+        with open(main.HISTORY_FILE, 'a') as outf:
+            outf.write('\n')
+        self.context.touch('history', main.HISTORY_FILE)
+        self.refresh()
+        self.assertListEqual(self.calls, ['output_folder'])
+
+    def test_proxy_changed(self):
+        self.refresh()
+        self.write_config(proxy_server='http://proxy.local', output_folder=self.folder)
+        run_config = self.refresh()
+        self.assertEqual(run_config.proxy_server, 'http://proxy.local')
+        self.assertListEqual(sorted(self.calls), ['engine', 'output_folder', 'proxy'])
+        self.assertEqual(self.context.reloads, 1)
+
+    def test_output_folder_changed(self):
+        self.refresh()
+        other = os.path.join(self.folder, 'other')
+        self.write_config(output_folder=other)
+        run_config = self.refresh()
+        self.assertEqual(run_config.output_folder, other)
+        self.assertListEqual(self.calls, ['output_folder'])
+
+    def test_output_folder_removed(self):
+        main.prepare_output_dir = self.origin[3]
+        other = os.path.join(self.folder, 'other')
+        self.write_config(output_folder=other)
+        self.refresh()
+        self.assertTrue(os.path.isdir(other))
+        os.rmdir(other)
+        self.refresh()
+        self.assertTrue(os.path.isdir(other))
+
+    def test_edit_while_loading(self):
+        load_config = main.load_config
+
+        def edit_after_parsing(*args):
+            run_config = load_config(*args)
+            self.write_config(proxy_server='http://proxy.local', output_folder=self.folder)
+            return run_config
+        main.load_config = edit_after_parsing
+        try:
+            self.assertEqual(self.refresh().proxy_server, '')
+        finally:
+            main.load_config = load_config
+        self.assertEqual(self.refresh().proxy_server, 'http://proxy.local')
+
+    def test_diff(self):
+        old = self.refresh()
+        new = main.copy(old)
+        new.setter = 'gnome3'
+        self.assertSetEqual(main.DaemonContext.diff(old, new), {'setter'})
+        self.assertSetEqual(main.DaemonContext.diff(old, old), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
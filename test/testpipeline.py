@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import unittest
+import threading
+import time
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import pipeline
+
+
+class TestDownloadPipeline(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = pipeline.DownloadPipeline(max_workers=4, per_host=2)
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.peak = dict()
+
+    def tearDown(self):
+        self.pipeline.shutdown()
+
+    def fake_download(self, host):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.running[host])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[host] -= 1
+        return host
+
+    def test_per_host_limit(self):
+        urls = ['http://a.com/%d' % i for i in range(6)] + ['http://b.com/%d' % i for i in range(2)]
+        futures = [
+            self.pipeline.submit(url, self.fake_download, url.split('/')[2])
+            for url in urls
+        ]
+        results = list(self.pipeline.results(futures))
+        self.assertEqual(len(results), len(urls))
+        self.assertEqual(self.peak['a.com'], 2)
+        self.assertEqual(self.peak['b.com'], 2)
+
+    def test_other_host_not_blocked(self):
+        began = time.time()
+        started = dict()
+
+        def download(url, delay):
+            started[url] = time.time() - began
+            time.sleep(delay)
+            return url
+        futures = [
+            self.pipeline.submit('http://a.com/%d' % i, download, 'http://a.com/%d' % i, 0.3)
+            for i in range(4)
+        ]
+        futures.append(self.pipeline.submit('http://b.com/0', download, 'http://b.com/0', 0))
+        self.assertEqual(len(list(self.pipeline.results(futures))), 5)
+        # queued downloads of a.com never hold workers b.com needs
+        self.assertLess(started['http://b.com/0'], 0.2)
+        self.assertGreaterEqual(started['http://a.com/2'], 0.25)
+
+    def test_cancel_pending(self):
+        gate = threading.Event()
+        futures = [self.pipeline.submit('http://a.com/%d' % i, gate.wait) for i in range(3)]
+        self.assertTrue(futures[2].cancel())
+        self.assertFalse(futures[0].cancel())
+        gate.set()
+        self.assertListEqual(list(self.pipeline.results(futures)), [True, True])
+
+    def test_failure_skipped(self):
+        def fail():
+            raise IOError('connection reset')
+        futures = [
+            self.pipeline.submit('http://a.com/0', fail),
+            self.pipeline.submit('http://a.com/1', lambda: 'ok'),
+        ]
+        self.assertListEqual(list(self.pipeline.results(futures)), ['ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
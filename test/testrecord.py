@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+import unittest
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import tracemalloc
+from collections import UserDict
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import record
+
+
+def make_record(i, raw=b'image', content_hash='hash', **kwargs):
+    return record.DownloadRecord(
+        'http://www.bing.com/photo{}.jpg'.format(i), '/tmp/photo{}.jpg'.format(i), 'photo {}'.format(i),
+        raw=raw, market='en-US', content_hash=content_hash,
+        start_time=datetime.datetime(2019, 5, 16, 7, 0) - datetime.timedelta(days=i),
+        **kwargs
+    )
+
+
+class LegacyRecord(UserDict):
+    # DownloadRecord of earlier versions, for memory comparison only
+    def __init__(self, url, local_file, description, download_time, start_time, raw):
+        UserDict.__init__(self)
+        self['url'] = url
+        self['local_file'] = local_file
+        self['description'] = description
+        self['time'] = download_time.isoformat()
+        self['start_time'] = start_time.isoformat()
+        self['end_time'] = None
+        self['raw'] = raw
+        self['is_accompany'] = False
+        self['market'] = 'en-US'
+        self['content_hash'] = None
+
+
+class TestDownloadRecord(unittest.TestCase):
+    def test_dict_access(self):
+        raw = b'image'
+        r = make_record(0, raw=raw)
+        self.assertEqual(r['start_time'], '2019-05-16T07:00:00')
+        self.assertIs(r['raw'], raw)
+        self.assertIsNone(r.get('end_time'))
+        self.assertSetEqual(set(r.keys()), set(record.DownloadRecord.FIELDS))
+        with self.assertRaises(KeyError):
+            r['unknown'] = 1
+
+        c = r.copy()
+        c.pop('raw')
+        c['market'] = 'zh-CN'
+        self.assertNotIn('raw', c)
+        self.assertEqual(r['market'], 'en-US')
+        loaded = record.DownloadRecord.from_dict(json.loads(json.dumps(dict(c))))
+        self.assertDictEqual(dict(loaded), dict(c))
+
+    @staticmethod
+    def measure(make, n=2000):
+        start = datetime.datetime(2019, 5, 16)
+        raw = b'image'
+        tracemalloc.start()
+        try:
+            records = [make(
+                'http://www.bing.com/photo{}.jpg'.format(i), '/tmp/photo{}.jpg'.format(i), 'photo',
+                start, start - datetime.timedelta(days=i), raw
+            ) for i in range(n)]
+            size = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del records
+        return size
+
+    def test_memory(self):
+        def make(url, local_file, description, download_time, start_time, raw):
+            return record.DownloadRecord(
+                url, local_file, description, download_time=download_time,
+                start_time=start_time, raw=raw, market='en-US'
+            )
+        slotted = self.measure(make)
+        legacy = self.measure(LegacyRecord)
+        self.assertLess(slotted * 3, legacy * 2)
+
+
+class TestSqlDatabaseRecordManager(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.folder, 'history.db')
+
+    def tearDown(self):
+        record.SqlDatabaseRecordManager.close_all()
+        shutil.rmtree(self.folder)
+
+    def save(self, records, split_images=False):
+        rm = record.SqlDatabaseRecordManager('test', split_images)
+        for r in records:
+            rm.add(r)
+        rm.save(self.dbfile)
+        return rm
+
+    def query(self, sql, *args):
+        conn = sqlite3.connect(self.dbfile)
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def test_batch_save(self):
+        self.save([make_record(i, content_hash='hash{}'.format(i)) for i in range(100)])
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperRecords')[0][0], 100)
+
+    def test_embedded_image(self):
+        rm = self.save([make_record(i) for i in range(3)])
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperRecords WHERE Image IS NOT NULL')[0][0], 3)
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperImages')[0][0], 0)
+        self.assertEqual(rm.load_image(self.dbfile, 'hash'), b'image')
+
+    def test_duplicated_image_in_batch(self):
+        rm = self.save([make_record(i) for i in range(3)], split_images=True)
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperImages')[0][0], 1)
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperRecords WHERE Image IS NOT NULL')[0][0], 0)
+        self.assertEqual(rm.load_image(self.dbfile, 'hash'), b'image')
+
+    def create_5_7_0(self):
+        conn = sqlite3.connect(self.dbfile)
+        conn.executescript('''
+            CREATE TABLE [BingWallpaperRecords] (
+              [Url] CHAR(1024) NOT NULL ON CONFLICT FAIL,
+              [DownloadTime] DATETIME NOT NULL ON CONFLICT FAIL,
+              [StartTime] DATETIME,
+              [EndTime] DATETIME,
+              [LocalFilePath] CHAR(1024),
+              [Description] TEXT(1024),
+              [Market] TEXT(64) DEFAULT "",
+              [Image] BLOB,
+              [IsAccompany] BOOLEAN DEFAULT False,
+              [ContentHash] CHAR(64) DEFAULT NULL,
+              CONSTRAINT [sqlite_autoindex_BingWallpaperRecords_1] PRIMARY KEY ([Url]));
+            CREATE TABLE [BingWallpaperCore] ([MajorVer] INTEGER, [MinorVer] INTEGER, [Build] INTEGER);
+            INSERT INTO [BingWallpaperCore] VALUES (5, 7, 0);
+            INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Image, ContentHash)
+              VALUES ('a', '2019-05-16', x'0102', 'hash');
+            INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Image, ContentHash)
+              VALUES ('b', '2019-05-16', NULL, 'hash');
+            INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Image)
+              VALUES ('c', '2019-05-16', x'0304');
+        ''')
+        conn.close()
+
+    def test_upgrade_keeps_images(self):
+        self.create_5_7_0()
+        rm = self.save([])
+        self.assertEqual(self.query('SELECT * FROM BingWallpaperCore'), [rm.LATEST_DB_VERSION])
+        self.assertEqual(
+            self.query('SELECT Url, Image, ContentHash FROM BingWallpaperRecords ORDER BY Url'),
+            [('a', b'\x01\x02', 'hash'), ('b', None, 'hash'), ('c', b'\x03\x04', None)]
+        )
+        self.assertEqual(rm.load_image(self.dbfile, 'hash'), b'\x01\x02')
+
+    def test_split_images(self):
+        self.create_5_7_0()
+        conn = sqlite3.connect(self.dbfile)
+        with conn:
+            conn.execute('''
+                INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Image)
+                  VALUES ('d', '2019-05-16', randomblob(1024 * 1024))
+            ''')
+        conn.close()
+        rm = self.save([], split_images=True)
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperRecords WHERE Image IS NOT NULL')[0][0], 0)
+        # space of moved images is given back
+        self.assertEqual(self.query('PRAGMA freelist_count')[0][0], 0)
+        self.assertEqual(rm.load_image(self.dbfile, 'hash'), b'\x01\x02')
+        content_hash = self.query("SELECT ContentHash FROM BingWallpaperRecords WHERE Url='c'")[0][0]
+        self.assertEqual(rm.load_image(self.dbfile, content_hash), b'\x03\x04')
+
+    def test_upgrade_from_5_6_1(self):
+        conn = sqlite3.connect(self.dbfile)
+        conn.executescript('''
+            CREATE TABLE [BingWallpaperRecords] (
+              [Url] CHAR(1024) NOT NULL ON CONFLICT FAIL,
+              [DownloadTime] DATETIME NOT NULL ON CONFLICT FAIL,
+              [StartTime] DATETIME,
+              [EndTime] DATETIME,
+              [LocalFilePath] CHAR(1024),
+              [Description] TEXT(1024),
+              [Market] TEXT(64) DEFAULT "",
+              [Image] BLOB,
+              [IsAccompany] BOOLEAN DEFAULT False,
+              CONSTRAINT [sqlite_autoindex_BingWallpaperRecords_1] PRIMARY KEY ([Url]));
+            CREATE TABLE [BingWallpaperCore] ([MajorVer] INTEGER, [MinorVer] INTEGER, [Build] INTEGER);
+            INSERT INTO [BingWallpaperCore] VALUES (5, 6, 1);
+            INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Market, Image)
+              VALUES ('a', '2019-05-16', 'en-US', x'0102');
+            INSERT INTO [BingWallpaperRecords] (Url, DownloadTime, Market, Image)
+              VALUES ('b', '2019-05-16', 'de-DE', x'0102');
+        ''')
+        conn.close()
+
+        rm = self.save([], split_images=True)
+        self.assertEqual(self.query('SELECT * FROM BingWallpaperCore'), [rm.LATEST_DB_VERSION])
+        content_hash = record.sha256(b'\x01\x02')
+        self.assertEqual(
+            self.query('SELECT Url, Market, ContentHash FROM BingWallpaperRecords ORDER BY Url'),
+            [('a', 'en-US', content_hash), ('b', 'de-DE', content_hash)]
+        )
+        # same image of two records is stored once
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperImages')[0][0], 1)
+        self.assertEqual(rm.load_image(self.dbfile, content_hash), b'\x01\x02')
+
+    def test_reuse_connection(self):
+        self.save([make_record(0, content_hash='hash0')])
+        conn = record.SqlDatabaseRecordManager._connections[self.dbfile]
+        self.save([make_record(1, content_hash='hash1')])
+        self.assertIs(record.SqlDatabaseRecordManager._connections[self.dbfile], conn)
+        self.assertEqual(self.query('SELECT count(*) FROM BingWallpaperRecords')[0][0], 2)
+        self.assertEqual(self.query('PRAGMA journal_mode')[0][0], 'wal')
+
+    def test_close_all(self):
+        self.save([make_record(0, content_hash='hash0')])
+        record.SqlDatabaseRecordManager.close_all()
+        self.assertFalse(os.path.exists(self.dbfile + '-wal'))
+        # database file alone holds all history
+        copied = os.path.join(self.folder, 'copied.db')
+        shutil.copyfile(self.dbfile, copied)
+        conn = sqlite3.connect(copied)
+        try:
+            self.assertEqual(conn.execute('SELECT count(*) FROM BingWallpaperRecords').fetchone()[0], 1)
+        finally:
+            conn.close()
+
+    def test_load(self):
+        self.save([make_record(i, content_hash='hash{}'.format(i)) for i in range(3)])
+        rm = record.SqlDatabaseRecordManager('test')
+        rm.load(self.dbfile)
+        self.assertEqual(len(rm), 3)
+        r = rm.get_by_url('http://www.bing.com/photo1.jpg')
+        self.assertEqual(r['local_file'], '/tmp/photo1.jpg')
+        self.assertEqual(r['content_hash'], 'hash1')
+        self.assertNotIn('raw', r)
+
+    def test_find_by_url(self):
+        rm = self.save([make_record(i) for i in range(3)])
+        self.assertEqual(rm.find_by_url(self.dbfile, 'http://www.bing.com/photo2.jpg')['description'], 'photo 2')
+        self.assertIsNone(rm.find_by_url(self.dbfile, 'http://www.bing.com/missing.jpg'))
+        plan = self.query(
+            'EXPLAIN QUERY PLAN ' + rm.SELECT_BY_URL, 'http://www.bing.com/photo2.jpg'
+        )
+        self.assertIn('INDEX', plan[0][-1])
+
+    def test_query(self):
+        records = [make_record(i) for i in range(10)]
+        records[3]['market'] = 'zh-CN'
+        rm = self.save(records + [make_record(99, is_accompany=True)])
+        found = rm.query(self.dbfile, since=datetime.date(2019, 5, 10), until=datetime.date(2019, 5, 15))
+        self.assertListEqual(
+            [r['url'] for r in found],
+            ['http://www.bing.com/photo{}.jpg'.format(i) for i in (2, 3, 4, 5, 6)]
+        )
+        found = rm.query(self.dbfile, market='zh-CN')
+        self.assertListEqual([r['url'] for r in found], ['http://www.bing.com/photo3.jpg'])
+        self.assertEqual(len(rm.query(self.dbfile, limit=2)), 2)
+
+class TestDownloadRecordManager(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.history = os.path.join(self.folder, 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_record(self, i):
+        r = make_record(i)
+        r['local_file'] = os.path.join(self.folder, 'photo{}.jpg'.format(i))
+        open(r['local_file'], 'w').close()
+        return r
+
+    def load(self):
+        rm = record.DownloadRecordManager('test')
+        with open(self.history) as f:
+            rm.load(f)
+        return rm
+
+    def lines(self):
+        with open(self.history) as f:
+            return f.read().splitlines()
+
+    def test_append(self):
+        rm = record.DownloadRecordManager('test')
+        rm.add(self.make_record(0))
+        rm.commit(self.history)
+        rm.add(self.make_record(1))
+        rm.commit(self.history)
+        self.assertEqual(len(self.lines()), 2)
+        self.assertNotIn('raw', json.loads(self.lines()[0]))
+        self.assertListEqual(
+            sorted(self.load().keys()),
+            ['http://www.bing.com/photo0.jpg', 'http://www.bing.com/photo1.jpg']
+        )
+
+    def test_clear(self):
+        rm = record.DownloadRecordManager('test')
+        rm.add(self.make_record(0))
+        rm.commit(self.history)
+        rm.clear()
+        rm.add(self.make_record(1))
+        rm.commit(self.history)
+        self.assertEqual(len(self.lines()), 3)
+        self.assertListEqual(list(self.load().keys()), ['http://www.bing.com/photo1.jpg'])
+
+    def test_compact(self):
+        rm = record.DownloadRecordManager('test')
+        for i in range(rm.COMPACT_MIN + 1):
+            rm.clear()
+            rm.add(self.make_record(0))
+            rm.commit(self.history)
+        self.assertLessEqual(len(self.lines()), rm.COMPACT_MIN)
+        self.assertListEqual(list(self.load().keys()), ['http://www.bing.com/photo0.jpg'])
+        self.assertFalse(os.path.exists(self.history + '.tmp'))
+
+    def test_legacy_history(self):
+        r0, r1 = self.make_record(0), self.make_record(1)
+        r1['local_file'] = os.path.join(self.folder, 'removed.jpg')
+        with open(self.history, 'w') as f:
+            json.dump({r['url']: dict(r, raw=None) for r in (r0, r1)}, f)
+        rm = self.load()
+        self.assertEqual(rm.get_by_url(r0['url'])['local_file'], r0['local_file'])
+        self.assertIs(rm.get_by_url(r1['url']), record.null_record)
+
+    def test_removed_file(self):
+        rm = record.DownloadRecordManager('test')
+        r = self.make_record(0)
+        rm.add(r)
+        rm.add(self.make_record(1))
+        rm.commit(self.history)
+        os.remove(r['local_file'])
+        rm = self.load()
+        self.assertEqual(len(rm), 2)
+        self.assertIs(rm.get_by_url(r['url']), record.null_record)
+        self.assertNotIn(r['url'], rm)
+        self.assertEqual(len(rm), 1)
+
+    def test_broken_line(self):
+        rm = record.DownloadRecordManager('test')
+        rm.add(self.make_record(0))
+        rm.commit(self.history)
+        with open(self.history, 'a') as f:
+            f.write('{"url": "http://www.bing.com/cut')
+        rm = self.load()
+        self.assertEqual(len(rm), 1)
+        rm.add(self.make_record(1))
+        rm.commit(self.history)
+        self.assertEqual(len(self.load()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
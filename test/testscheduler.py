@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import unittest
+from datetime import datetime, timedelta
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import scheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2019, 5, 16, 12, 0)
+        self.poller = scheduler.PollScheduler(
+            interval=7200,
+            clock=lambda: self.now,
+            rand=lambda a, b: 0,
+        )
+
+    def test_interval_mode(self):
+        self.poller.configure('interval', 3600)
+        self.poller.observe('en-US', datetime(2019, 5, 16, 7, 0))
+        self.assertEqual(self.poller.succeeded(), 3600)
+
+    def test_unknown_publish_time(self):
+        self.assertEqual(self.poller.succeeded(), 7200)
+
+    def test_wait_for_next_publish(self):
+        self.poller.observe('en-US', datetime(2019, 5, 16, 7, 0))
+        self.assertEqual(self.poller.succeeded(), 19 * 3600)
+
+    def test_earliest_market(self):
+        self.poller.observe('en-US', datetime(2019, 5, 16, 7, 0))
+        self.poller.observe('zh-CN', datetime(2019, 5, 15, 16, 0))
+        self.assertEqual(self.poller.succeeded(), 4 * 3600)
+
+    def test_late_photo(self):
+        self.poller.observe('en-US', datetime(2019, 5, 15, 7, 0))
+        self.assertEqual(self.poller.succeeded(), 600)
+        self.assertEqual(self.poller.succeeded(), 1200)
+        self.assertEqual(self.poller.succeeded(), 2400)
+        # never more seldom than interval
+        self.assertEqual(self.poller.succeeded(), 3600)
+        self.now += timedelta(hours=1)
+        self.poller.observe('en-US', datetime(2019, 5, 16, 7, 0))
+        self.assertEqual(self.poller.succeeded(), 18 * 3600)
+        self.assertEqual(self.poller.late, 0)
+
+    def test_backoff_on_error(self):
+        self.assertListEqual(
+            [self.poller.failed() for _ in range(8)],
+            [60, 120, 240, 480, 960, 1920, 3600, 3600]
+        )
+        self.poller.succeeded()
+        self.assertEqual(self.poller.failed(), 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
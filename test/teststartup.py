@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import subprocess
+
+import sys
+sys.path.append('..')
+
+
+class TestStartupImports(unittest.TestCase):
+    # modules needed only by some configs, they must not slow down every start
+    LAZY_MODULES = (
+        'pybingwallpaper.ntlmauth',
+        'pybingwallpaper.aioweb',
+        'pybingwallpaper.winsetter',
+        'sqlite3',
+        'asyncio',
+    )
+
+    def import_times(self, module):
+        out = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            stderr=subprocess.STDOUT,
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+            universal_newlines=True,
+        )
+        times = dict()
+        for line in out.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+        return times
+
+    def test_lazy_modules(self):
+        times = self.import_times('pybingwallpaper.main')
+        self.assertIn('pybingwallpaper.main', times)
+        for name in times:
+            for lazy in self.LAZY_MODULES:
+                self.assertFalse(
+                    name == lazy or name.startswith(lazy + '.'),
+                    '{} is imported at start up'.format(name)
+                )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import unittest
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import store
+
+
+class TestContentStore(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.store = store.ContentStore('test')
+        self.link = os.link
+
+    def tearDown(self):
+        os.link = self.link
+        shutil.rmtree(self.folder)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as outf:
+            outf.write(content)
+        return path, hashlib.sha256(content).hexdigest()
+
+    def test_reuse(self):
+        path, digest = self.write('a.jpg', b'photo')
+        self.assertEqual(self.store.add(path, digest, 'hsh_1920x1080.jpg'), path)
+        outfile = os.path.join(self.folder, 'b.jpg')
+        self.assertEqual(self.store.reuse('hsh_1920x1080.jpg', outfile), digest)
+        self.assertTrue(os.path.samefile(path, outfile))
+        self.assertEqual(self.store.bytes_saved, 5)
+        self.assertIsNone(self.store.reuse('other_1920x1080.jpg', outfile))
+
+    def test_already_linked(self):
+        path, digest = self.write('a.jpg', b'photo')
+        self.store.add(path, digest, 'hsh')
+        outfile = os.path.join(self.folder, 'b.jpg')
+        for _ in range(3):
+            self.assertEqual(self.store.reuse('hsh', outfile), digest)
+            self.assertEqual(self.store.add(outfile, digest, 'hsh'), path)
+        self.assertEqual(self.store.add(path, digest, 'hsh'), path)
+        self.assertEqual(self.store.bytes_saved, 5)
+
+    def test_same_content(self):
+        path, digest = self.write('a.jpg', b'photo')
+        self.store.add(path, digest)
+        other, _ = self.write('b.jpg', b'photo')
+        self.assertEqual(self.store.add(other, digest), path)
+        self.assertTrue(os.path.samefile(path, other))
+
+    def test_stale_blob(self):
+        path, digest = self.write('a.jpg', b'photo')
+        self.store.add(path, digest, 'hsh')
+        self.write('a.jpg', b'edited photo')
+        outfile = os.path.join(self.folder, 'b.jpg')
+        self.assertIsNone(self.store.reuse('hsh', outfile))
+        self.assertFalse(os.path.exists(outfile))
+        self.assertNotIn(digest, self.store.blobs)
+
+    def test_cross_device(self):
+        def link(src, dst):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+        os.link = link
+        path, digest = self.write('a.jpg', b'photo')
+        self.store.add(path, digest, 'hsh')
+        outfile = os.path.join(self.folder, 'b.jpg')
+        self.assertIsNone(self.store.reuse('hsh', outfile))
+        # a separate copy is kept and nothing is left behind
+        other, _ = self.write('b.jpg', b'photo')
+        self.assertEqual(self.store.add(other, digest), other)
+        self.assertListEqual(sorted(os.listdir(self.folder)), ['a.jpg', 'b.jpg'])
+        self.assertEqual(self.store.bytes_saved, 0)
+
+    def test_save_and_load(self):
+        path, digest = self.write('a.jpg', b'photo')
+        self.store.add(path, digest, 'hsh')
+        with open(os.path.join(self.folder, 'store.json'), 'w') as f:
+            self.store.save(f)
+        loaded = store.ContentStore('loaded')
+        with open(os.path.join(self.folder, 'store.json')) as f:
+            loaded.load(f)
+        self.assertEqual(loaded.find_by_hash('hsh'), (digest, os.path.abspath(path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
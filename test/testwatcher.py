@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import sys
+sys.path.append('..')
+
+from pybingwallpaper import watcher
+
+
+class TestStatWatcher(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'settings.conf')
+        self.write('a = 1\n')
+        self.watcher = self.get_watcher()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.folder)
+
+    def get_watcher(self):
+        return watcher.StatWatcher(self.path)
+
+    def write(self, content, path=None):
+        with open(path or self.path, 'w') as f:
+            f.write(content)
+
+    def test_unchanged(self):
+        self.assertFalse(self.watcher.changed())
+        self.write('a = 1\n', os.path.join(self.folder, 'other.conf'))
+        self.assertFalse(self.watcher.changed())
+
+    def test_modified(self):
+        self.write('a = 22\n')
+        self.assertTrue(self.watcher.changed())
+        self.assertFalse(self.watcher.changed())
+
+    def test_replaced(self):
+        tmp = os.path.join(self.folder, 'settings.conf.tmp')
+        self.write('a = 2\n', tmp)
+        os.rename(tmp, self.path)
+        self.assertTrue(self.watcher.changed())
+
+    def test_removed_and_created(self):
+        os.remove(self.path)
+        self.assertTrue(self.watcher.changed())
+        self.assertFalse(self.watcher.changed())
+        self.write('a = 1\n')
+        self.assertTrue(self.watcher.changed())
+
+
+@unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is available on linux only')
+class TestInotifyWatcher(TestStatWatcher):
+    def setUp(self):
+        TestStatWatcher.setUp(self)
+        self.other = None
+
+    def tearDown(self):
+        if self.other:
+            self.other.close()
+        TestStatWatcher.tearDown(self)
+
+    def get_watcher(self):
+        return watcher.InotifyWatcher(self.path)
+
+    def test_watch(self):
+        self.other = watcher.watch(self.path)
+        self.assertIsInstance(self.other, watcher.InotifyWatcher)
+
+    def test_folder_removed(self):
+        shutil.rmtree(self.folder)
+        self.assertTrue(self.watcher.changed())
+        self.assertTrue(self.watcher.polling)
+        os.mkdir(self.folder)
+        self.write('a = 3\n')
+        self.assertTrue(self.watcher.changed())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+
+import unittest
+import asyncio
+import base64
+import functools
+import gzip
+import hashlib
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+import sys
+sys.path.append('..')
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from pybingwallpaper import aioweb
+from pybingwallpaper import webutil
+from pybingwallpaper.ntlmauth import ntlm
+
+
+class KeepAliveHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    content = b''
+    etag = '"v1"'
+    # drop the connection after sending so many bytes, None to never break
+    break_after = None
+    ranges = list()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        start, end = 0, len(cls.content)
+        status = 200
+        range_ = self.headers.get('Range', None)
+        if range_ and self.headers.get('If-Range', cls.etag) == cls.etag:
+            first, last = range_.split('=')[1].split('-')
+            start, end = int(first), int(last) + 1 if last else len(cls.content)
+            status = 206
+        cls.ranges.append(range_)
+        self.send_response(status)
+        self.send_header('ETag', cls.etag)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, len(cls.content)))
+        self.end_headers()
+        body = cls.content[start:end]
+        if cls.break_after is not None:
+            body = body[:cls.break_after]
+            self.close_connection = True
+        self.wfile.write(body)
+
+
+class HeadRefusedHandler(RangeHandler):
+    head_status = 405
+
+    def do_HEAD(self):
+        self.send_response(type(self).head_status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    pieces = 5
+    interval = 0.2
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        self.send_response(200)
+        self.send_header('Content-Length', str(cls.pieces * 1024))
+        self.end_headers()
+        for _ in range(cls.pieces):
+            self.wfile.write(b'x' * 1024)
+            self.wfile.flush()
+            time.sleep(cls.interval)
+
+
+class CachedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    content = b'{}'
+    etag = '"v1"'
+    max_age = 0
+    statuses = list()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        cls = type(self)
+        status = 304 if self.headers.get('If-None-Match', None) == cls.etag else 200
+        cls.statuses.append(status)
+        body = cls.content if status == 200 else b''
+        self.send_response(status)
+        self.send_header('ETag', cls.etag)
+        self.send_header('Cache-Control', 'max-age={}'.format(cls.max_age))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class NtlmProxyHandler(BaseHTTPRequestHandler):
+    """
+    http proxy which authenticates each connection by NTLM, then serves
+    url path as content. the credentials are not verified
+    """
+    protocol_version = 'HTTP/1.1'
+    user = 'user'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.authenticated = False
+        self.server.connections += 1
+
+    def reply(self, code, headers=(), body=b''):
+        self.send_response(code)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def challenge():
+        msg = b'NTLMSSP\0' + struct.pack('<IHHII', 2, 0, 0, 48, ntlm.NTLM_ttype2_FLAGS)
+        msg += b'\x01\x23\x45\x67\x89\xab\xcd\xef' + b'\0' * 8 + struct.pack('<HHI', 0, 0, 48)
+        return 'NTLM ' + base64.b64encode(msg).decode()
+
+    def authenticate(self, auth):
+        msg = base64.b64decode(auth[5:])
+        msg_type = struct.unpack('<I', msg[8:12])[0]
+        if msg_type == 1:
+            self.server.handshakes += 1
+            self.reply(407, [('Proxy-Authenticate', self.challenge())])
+            return False
+        length, _, offset = struct.unpack('<HHI', msg[36:44])
+        self.authenticated = msg[offset:offset + length].decode('utf-16-le') == self.user
+        if not self.authenticated:
+            self.reply(407, [('Proxy-Authenticate', 'NTLM')])
+        return self.authenticated
+
+    def do_GET(self):
+        auth = self.headers.get('Proxy-Authorization', '')
+        if not self.authenticated:
+            if not auth.startswith('NTLM '):
+                self.reply(407, [('Proxy-Authenticate', 'NTLM')])
+                return
+            elif not self.authenticate(auth):
+                return
+        self.reply(200, body=self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class TestServer(ThreadingHTTPServer):
+    # many clients connect at the same time, don't drop them from backlog
+    request_queue_size = 64
+
+
+class WebUtilTestBase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp()
+        cls.content = os.urandom(200 * 1024)
+        with open(os.path.join(cls.root, 'image.jpg'), 'wb') as outf:
+            outf.write(cls.content)
+        with open(os.path.join(cls.root, 'page.gz'), 'wb') as outf:
+            outf.write(gzip.compress(cls.content, mtime=0))
+        cls.server = TestServer(
+            ('127.0.0.1', 0), functools.partial(KeepAliveHandler, directory=cls.root)
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = 'http://127.0.0.1:{}/'.format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        webutil.default_pool.clear()
+        cls.server.shutdown()
+        cls.server.server_close()
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        webutil.default_pool.clear()
+
+
+class TestConnectionPool(WebUtilTestBase):
+    def test_reuse_connection(self):
+        before = webutil.default_pool.stats()
+        for _ in range(3):
+            self.assertEqual(webutil.loadurl(self.base + 'image.jpg'), self.content)
+        after = webutil.default_pool.stats()
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 2)
+        self.assertEqual(after['idle'], 1)
+
+    def test_evict_idle_connection(self):
+        pool = webutil.default_pool
+        webutil.loadurl(self.base + 'image.jpg')
+        timeout, pool.idle_timeout = pool.idle_timeout, -1
+        try:
+            evictions = pool.stats()['evictions']
+            webutil.loadurl(self.base + 'image.jpg')
+            self.assertEqual(pool.stats()['evictions'], evictions + 1)
+        finally:
+            pool.idle_timeout = timeout
+
+
+class TestProbe(WebUtilTestBase):
+    def test_probe_existing(self):
+        result = webutil.probe(self.base + 'image.jpg')
+        self.assertTrue(result.exists)
+        self.assertEqual(result.content_length, len(self.content))
+        self.assertIsNotNone(result.last_modified)
+
+    def test_probe_missing(self):
+        result = webutil.probe(self.base + 'missing.jpg')
+        self.assertFalse(result.exists)
+        self.assertEqual(result.status, 404)
+
+    def test_probe_candidates(self):
+        url, timings = webutil.probe_candidates([
+            self.base + 'missing.jpg', self.base + 'image.jpg', self.base + 'other.jpg'
+        ])
+        self.assertEqual(url, self.base + 'image.jpg')
+        self.assertIn(self.base + 'missing.jpg', timings)
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    instances = list()
+
+    def __init__(self, *args, **kwargs):
+        ThreadPoolExecutor.__init__(self, *args, **kwargs)
+        self.shut_down = False
+        type(self).instances.append(self)
+
+    def shutdown(self, *args, **kwargs):
+        self.shut_down = True
+        ThreadPoolExecutor.shutdown(self, *args, **kwargs)
+
+
+class TestProbeCandidates(unittest.TestCase):
+    def setUp(self):
+        RecordingExecutor.instances = list()
+        self.executor, webutil.ThreadPoolExecutor = webutil.ThreadPoolExecutor, RecordingExecutor
+
+    def tearDown(self):
+        webutil.ThreadPoolExecutor = self.executor
+
+    def test_priority_over_speed(self):
+        def probe(url):
+            if url == 'high':
+                time.sleep(0.3)
+            return True
+        url, timings = webutil.probe_candidates(['high', 'low'], probe)
+        self.assertEqual(url, 'high')
+        self.assertGreaterEqual(timings['high'], 0.3)
+        self.assertEqual(len(RecordingExecutor.instances), 1)
+        self.assertTrue(RecordingExecutor.instances[0].shut_down)
+
+    def test_none_exists(self):
+        def probe(url):
+            if url == 'broken':
+                raise IOError('unreachable')
+            return False
+        url, timings = webutil.probe_candidates(['missing', 'broken', 'other'], probe)
+        self.assertIsNone(url)
+        self.assertSetEqual(set(timings), {'missing', 'broken', 'other'})
+        self.assertEqual(len(RecordingExecutor.instances), 1)
+        self.assertTrue(RecordingExecutor.instances[0].shut_down)
+
+
+class TestProbeFallback(unittest.TestCase):
+    def setUp(self):
+        HeadRefusedHandler.content = os.urandom(1024)
+        HeadRefusedHandler.ranges = list()
+        self.server = TestServer(('127.0.0.1', 0), HeadRefusedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/image.jpg'.format(self.server.server_address[1])
+        self.opened = list()
+        self.urlopen, webutil.urlopen = webutil.urlopen, self.spy
+
+    def tearDown(self):
+        webutil.urlopen = self.urlopen
+        webutil.default_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def spy(self, req):
+        con = self.urlopen(req)
+        self.opened.append(con)
+        return con
+
+    def assertFallback(self, head_status):
+        HeadRefusedHandler.head_status = head_status
+        result = webutil.probe(self.url)
+        self.assertTrue(result.exists)
+        self.assertEqual(result.status, 206)
+        self.assertEqual(result.content_length, len(HeadRefusedHandler.content))
+        self.assertTrue(result.accept_ranges)
+        self.assertEqual(HeadRefusedHandler.ranges, ['bytes=0-0'])
+        # the ranged response is dropped unread and never goes back to pool
+        self.assertEqual(len(self.opened), 1)
+        self.assertTrue(self.opened[0].isclosed())
+        self.assertEqual(webutil.default_pool.stats()['idle'], 0)
+
+    def test_head_not_allowed(self):
+        self.assertFallback(405)
+
+    def test_head_not_implemented(self):
+        self.assertFallback(501)
+
+
+class TestDownload(WebUtilTestBase):
+    def test_download(self):
+        outfile = os.path.join(self.root, 'saved.jpg')
+        self.assertEqual(webutil.download(self.base + 'image.jpg', outfile), len(self.content))
+        with open(outfile, 'rb') as inf:
+            self.assertEqual(inf.read(), self.content)
+
+    def test_download_missing(self):
+        outfile = os.path.join(self.root, 'saved-missing.jpg')
+        self.assertIsNone(webutil.download(self.base + 'missing.jpg', outfile, optional=True))
+        self.assertFalse(os.path.exists(outfile))
+
+    def test_download_gzipped(self):
+        outfile = os.path.join(self.root, 'saved-page')
+        digest = hashlib.sha256()
+        # decoded across many small chunks
+        size = webutil.download(self.base + 'page.gz', outfile, chunk_size=1024, digest=digest)
+        self.assertEqual(size, len(self.content))
+        with open(outfile, 'rb') as inf:
+            self.assertEqual(inf.read(), self.content)
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(self.content).hexdigest())
+
+    def test_download_broken(self):
+        RangeHandler.content = os.urandom(300 * 1024)
+        RangeHandler.break_after = 100 * 1024
+        server = TestServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        folder = tempfile.mkdtemp(dir=self.root)
+        outfile = os.path.join(folder, 'saved.jpg')
+        with open(outfile, 'wb') as outf:
+            outf.write(b'old')
+        try:
+            url = 'http://127.0.0.1:{}/video.mp4'.format(server.server_address[1])
+            self.assertIsNone(webutil.download(url, outfile, optional=True))
+        finally:
+            RangeHandler.break_after = None
+            server.shutdown()
+            server.server_close()
+        # the existing file is untouched and the temporary file is removed
+        self.assertEqual(os.listdir(folder), ['saved.jpg'])
+        with open(outfile, 'rb') as inf:
+            self.assertEqual(inf.read(), b'old')
+
+
+class ResumableTestBase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        RangeHandler.content = os.urandom(300 * 1024)
+        RangeHandler.etag = '"v1"'
+        RangeHandler.break_after = None
+        RangeHandler.ranges = list()
+        self.server = TestServer(('127.0.0.1', 0), RangeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/video.mp4'.format(self.server.server_address[1])
+        self.outfile = os.path.join(self.root, 'video.mp4')
+
+    def tearDown(self):
+        webutil.default_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def assertSaved(self, content):
+        with open(self.outfile, 'rb') as inf:
+            self.assertEqual(inf.read(), content)
+        self.assertFalse(os.path.exists(self.outfile + '.part'))
+        self.assertFalse(os.path.exists(self.outfile + '.part.json'))
+
+
+class TestResumableDownload(ResumableTestBase):
+    def test_resume_broken_transfer(self):
+        RangeHandler.break_after = 100 * 1024
+        self.assertIsNone(webutil.download_resumable(self.url, self.outfile, optional=True))
+        self.assertFalse(os.path.exists(self.outfile))
+        self.assertEqual(os.path.getsize(self.outfile + '.part'), 100 * 1024)
+
+        RangeHandler.break_after = None
+        self.assertEqual(webutil.download_resumable(self.url, self.outfile), len(RangeHandler.content))
+        self.assertEqual(RangeHandler.ranges[-1], 'bytes={}-{}'.format(100 * 1024, 300 * 1024 - 1))
+        self.assertSaved(RangeHandler.content)
+
+    def test_restart_changed_file(self):
+        RangeHandler.break_after = 100 * 1024
+        webutil.download_resumable(self.url, self.outfile, optional=True)
+
+        RangeHandler.break_after = None
+        RangeHandler.content = os.urandom(200 * 1024)
+        RangeHandler.etag = '"v2"'
+        self.assertEqual(webutil.download_resumable(self.url, self.outfile), len(RangeHandler.content))
+        self.assertSaved(RangeHandler.content)
+
+    def test_parallel_segments(self):
+        download = webutil.ResumableDownload(self.url, self.outfile, segments=3)
+        download.MIN_SEGMENT_SIZE = 64 * 1024
+        digest = hashlib.sha256()
+        self.assertEqual(download.run(digest), len(RangeHandler.content))
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(RangeHandler.content).hexdigest())
+        self.assertEqual(len([r for r in RangeHandler.ranges if r != 'bytes=0-0']), 3)
+        self.assertSaved(RangeHandler.content)
+
+
+class TestSegmentsRangeIgnored(ResumableTestBase):
+    def setUp(self):
+        ResumableTestBase.setUp(self)
+        self.opened = list()
+        self.urlopen, webutil.urlopen = webutil.urlopen, self.spy
+
+    def tearDown(self):
+        webutil.urlopen = self.urlopen
+        ResumableTestBase.tearDown(self)
+
+    def spy(self, req):
+        con = self.urlopen(req)
+        self.opened.append(con)
+        return con
+
+    def download(self):
+        download = webutil.ResumableDownload(self.url, self.outfile, optional=True, segments=3)
+        download.MIN_SEGMENT_SIZE = 64 * 1024
+        return download.run()
+
+    def test_all_responses_closed(self):
+        RangeHandler.break_after = 10 * 1024
+        self.assertIsNone(self.download())
+
+        # every segment gets the whole changed file instead of its range
+        RangeHandler.break_after = None
+        RangeHandler.content = os.urandom(200 * 1024)
+        RangeHandler.etag = '"v2"'
+        self.assertEqual(self.download(), len(RangeHandler.content))
+        self.assertSaved(RangeHandler.content)
+        self.assertListEqual([con for con in self.opened if not con.isclosed()], [])
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        CachedHandler.content = b'{"images": []}'
+        CachedHandler.etag = '"v1"'
+        CachedHandler.max_age = 0
+        CachedHandler.statuses = list()
+        self.server = TestServer(('127.0.0.1', 0), CachedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/archive'.format(self.server.server_address[1])
+        self.cache = webutil.HttpCache(os.path.join(self.root, 'cache'))
+
+    def tearDown(self):
+        webutil.default_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_not_modified(self):
+        self.assertEqual(webutil.load_cached(self.url, self.cache), (CachedHandler.content, False))
+        self.assertEqual(webutil.load_cached(self.url, self.cache), (CachedHandler.content, True))
+        self.assertListEqual(CachedHandler.statuses, [200, 304])
+
+        CachedHandler.content = b'{"images": [{}]}'
+        CachedHandler.etag = '"v2"'
+        self.assertEqual(webutil.load_cached(self.url, self.cache), (CachedHandler.content, False))
+        self.assertListEqual(CachedHandler.statuses, [200, 304, 200])
+
+    def test_fresh(self):
+        CachedHandler.max_age = 60
+        webutil.load_cached(self.url, self.cache)
+        self.assertEqual(webutil.load_cached(self.url, self.cache), (CachedHandler.content, True))
+        # no request is sent while cache is fresh
+        self.assertListEqual(CachedHandler.statuses, [200])
+
+    def test_invalidate(self):
+        CachedHandler.max_age = 60
+        webutil.load_cached(self.url, self.cache)
+        self.cache.invalidate(self.url)
+        self.assertEqual(self.cache.lookup(self.url), (None, None))
+        self.assertEqual(webutil.load_cached(self.url, self.cache), (CachedHandler.content, False))
+        self.assertListEqual(CachedHandler.statuses, [200, 200])
+
+    def test_failed_write(self):
+        webutil.load_cached(self.url, self.cache)
+        with self.assertRaises(TypeError):
+            self.cache.annotate(self.url, {'files': object()})
+        # the entry is kept as it was and no temporary file is left
+        entry, body = self.cache.lookup(self.url)
+        self.assertEqual(body, CachedHandler.content)
+        self.assertNotIn('note', entry)
+        self.assertEqual(len(os.listdir(self.cache.folder)), 2)
+
+    def test_note(self):
+        webutil.load_cached(self.url, self.cache)
+        self.cache.annotate(self.url, {'files': ['a.jpg']})
+        webutil.load_cached(self.url, self.cache)
+        self.assertEqual(self.cache.note(self.url), {'files': ['a.jpg']})
+        # note is about the old content
+        CachedHandler.etag = '"v2"'
+        webutil.load_cached(self.url, self.cache)
+        self.assertIsNone(self.cache.note(self.url))
+
+
+class TestNtlmProxy(unittest.TestCase):
+    def setUp(self):
+        self.server = TestServer(('127.0.0.1', 0), NtlmProxyHandler)
+        self.server.connections = 0
+        self.server.handshakes = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        webutil.remove_proxy()
+        webutil.default_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def setup_proxy(self, username):
+        webutil.setup_proxy(
+            ('http',), 'http://127.0.0.1', self.server.server_address[1],
+            ['http://www.bing.com'], username, 'secret'
+        )
+
+    def test_authenticated_connection_reused(self):
+        self.setup_proxy('DOMAIN\\user')
+        for i in range(3):
+            url = 'http://www.bing.com/photo{}.jpg'.format(i)
+            self.assertEqual(webutil.loadurl(url), url.encode())
+        self.assertEqual(self.server.handshakes, 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_rejected(self):
+        self.setup_proxy('DOMAIN\\intruder')
+        self.assertIsNone(webutil.loadurl('http://www.bing.com/photo.jpg'))
+
+
+class AsyncioEngineMixin:
+    def setUp(self):
+        self.assertEqual(webutil.set_engine('asyncio'), 'asyncio')
+        super().setUp()
+
+    def tearDown(self):
+        webutil.set_engine('urllib')
+        aioweb.default_engine().clear()
+        super().tearDown()
+
+
+class TestAsyncioProbe(AsyncioEngineMixin, TestProbe):
+    pass
+
+
+class TestAsyncioDownload(AsyncioEngineMixin, TestDownload):
+    pass
+
+
+class TestAsyncioResumableDownload(AsyncioEngineMixin, TestResumableDownload):
+    pass
+
+
+class TestAsyncEngine(WebUtilTestBase):
+    def setUp(self):
+        self.engine = aioweb.AsyncEngine(timeout=5)
+
+    def tearDown(self):
+        self.engine.clear()
+
+    def test_reuse_connection(self):
+        for _ in range(3):
+            response = self.engine.urlopen(webutil.Request(self.base + 'image.jpg'))
+            self.assertEqual(response.read(), self.content)
+        stats = self.engine.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+
+    def test_many_requests_in_one_loop(self):
+        async def fetch():
+            response = await self.engine.request('GET', self.base + 'image.jpg')
+            return await response.read()
+
+        async def fetch_all():
+            return await asyncio.gather(*[fetch() for _ in range(50)])
+
+        self.assertListEqual(self.engine.call(fetch_all()), [self.content] * 50)
+
+    def test_timeout_per_read(self):
+        server = TestServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        engine = aioweb.AsyncEngine(timeout=0.5)
+        try:
+            url = 'http://127.0.0.1:{}/slow'.format(server.server_address[1])
+            # the whole body takes longer than timeout, every piece doesn't
+            response = engine.urlopen(webutil.Request(url))
+            self.assertEqual(response.read(), b'x' * 5 * 1024)
+        finally:
+            engine.clear()
+            server.shutdown()
+            server.server_close()
+
+    def test_timeout(self):
+        async def never():
+            await asyncio.sleep(10)
+        with self.assertRaises(socket.timeout):
+            self.engine.call(never(), timeout=0.1)